@@ -18,7 +18,7 @@ from transformers import AutoTokenizer
 from src.dataloader import give_dataset
 # from src.txtdataloader import give_dataset
 from src.optimizer import give_scheduler, LinearWarmupCosineAnnealingLR
-from src.utils import same_seeds, Logger, get_weight_balancing, set_param_in_device, step_params, resume_train_state, load_pretrain_model, add_tokens_tokenizer
+from src.utils import same_seeds, Logger, get_weight_balancing, set_param_in_device, step_params, resume_train_state, load_pretrain_model, AsyncCheckpointer, add_tokens_tokenizer
 from src.eval import val, PA_val
 # model
 from src.models.rendezvous import Rendezvous
@@ -38,7 +38,10 @@ def train_one_epoch(config, model, activation, train_loader, loss_functions, opt
         if config.trainer.dataset == 'T50':
             b, m, c, h, w = img.size()
             img = img.view(-1, c, h, w)
+        img = img.contiguous(memory_format=torch.channels_last)
         
+        # EndoForm runs its backbone under bf16 autocast internally and returns fp32 logits,
+        # backward stays outside autocast, the losses below are computed in fp32
         tool, verb, target, triplet = model(img)
         logit_i  = tool
         logit_v  = verb
@@ -105,7 +108,7 @@ if __name__ == '__main__':
     same_seeds(50)
     logging_dir = os.getcwd() + '/logs/' + str(datetime.now())
     accelerator = Accelerator(cpu=False, log_with=["tensorboard"], logging_dir=logging_dir)
-    Logger(logging_dir if accelerator.is_local_main_process else None)
+    logger = Logger(logging_dir if accelerator.is_local_main_process else None)
     accelerator.init_trackers(os.path.split(__file__)[-1].split(".")[0])
     accelerator.print(objstr(config), flush=True)
     
@@ -114,7 +117,10 @@ if __name__ == '__main__':
     train_loader, val_loader, test_loader = give_dataset(config)
     
     # load model
-    model = EndoForm(in_channels=3)
+    # compiled at one level only: the Blocks in place (trainer.compile_blocks) or the whole model (trainer.compile)
+    compile_blocks = config.trainer.get('compile_blocks', False)
+    compile_model = config.trainer.compile and not compile_blocks
+    model = EndoForm(in_channels=3, conv_norm=config.trainer.get('conv_norm', False), compile_blocks=compile_blocks, fused_norm=not compile_model)
     
     # optimizer
     optimizer = torch.optim.SGD(model.parameters(), lr=config.trainer.lr[0], weight_decay=1e-6, momentum=0.95)
@@ -127,11 +133,11 @@ if __name__ == '__main__':
     activation = nn.Sigmoid()
     
     # loss
-    tool_weight, verb_weight, target_weight = get_weight_balancing(config)
+    tool_weight, verb_weight, target_weight = get_weight_balancing(config, train_loader.dataset)
     loss_functions = {
-        'loss_fn_i': nn.BCEWithLogitsLoss(pos_weight=torch.tensor(tool_weight).to(accelerator.device)),
-        'loss_fn_v': nn.BCEWithLogitsLoss(pos_weight=torch.tensor(verb_weight).to(accelerator.device)),
-        'loss_fn_t': nn.BCEWithLogitsLoss(pos_weight=torch.tensor(target_weight).to(accelerator.device)),
+        'loss_fn_i': nn.BCEWithLogitsLoss(pos_weight=tool_weight.to(accelerator.device, non_blocking=True)),
+        'loss_fn_v': nn.BCEWithLogitsLoss(pos_weight=verb_weight.to(accelerator.device, non_blocking=True)),
+        'loss_fn_t': nn.BCEWithLogitsLoss(pos_weight=target_weight.to(accelerator.device, non_blocking=True)),
         'loss_fn_ivt': nn.BCEWithLogitsLoss(),
     }
     
@@ -141,6 +147,8 @@ if __name__ == '__main__':
     start_num_epochs = 0
     best_score = torch.nn.Parameter(torch.tensor([0.0]), requires_grad=False)
     best_metrics = {}
+    # model.pth is written in the background while the next epoch trains
+    checkpointer = AsyncCheckpointer()
     
     # resume
     if config.trainer.resume.train:
@@ -148,6 +156,10 @@ if __name__ == '__main__':
     if config.trainer.resume.test:
         model = load_pretrain_model(f"{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/best/new/pytorch_model.bin", model, accelerator)
     
+    # compile, after resume so the checkpoint keys carry no _orig_mod. prefix
+    if compile_model:
+        model = torch.compile(model, mode="reduce-overhead", dynamic=False)
+    
     # set in device
     model, train_loader, val_loader, optimizer, scheduler = accelerator.prepare(model, train_loader, val_loader, optimizer, scheduler)
     
@@ -165,7 +177,7 @@ if __name__ == '__main__':
                     best_metrics = metrics
                     # two types of modeling saving
                     accelerator.save_state(output_dir=f"{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/best/new/")
-                    torch.save(model.state_dict(), f"{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/best/new/model.pth")
+                    checkpointer.save(model.state_dict(), f"{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/best/new/model.pth")
                     torch.save({'epoch': epoch, 'best_score': best_score, 'best_metrics': best_metrics, 'train_step': train_step, 'val_step': val_step},
                             f'{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/best/epoch.pth.tar')
                     
@@ -178,6 +190,7 @@ if __name__ == '__main__':
                 torch.save({'epoch': epoch, 'best_score': best_score, 'best_metrics': best_metrics, 'train_step': train_step, 'val_step': val_step},
                             f'{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/checkpoint/epoch.pth.tar')
                 accelerator.print('Checkout Over!')
+                logger.sync()
     
     # val
     if config.trainer.is_train != True:
@@ -185,6 +198,7 @@ if __name__ == '__main__':
      
     accelerator.print(f"dice ivt score: {best_score}")
     accelerator.print(f"other metrics : {best_metrics}")
+    checkpointer.wait()
     sys.exit(1) 
             
     
\ No newline at end of file
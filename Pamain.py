@@ -1,5 +1,7 @@
 import os
 import sys
+import shutil
+import hashlib
 import pytz
 import yaml
 import monai
@@ -18,7 +20,7 @@ from transformers import AutoTokenizer
 # from src.dataloader import give_dataset
 from src.txtdataloader import give_dataset
 from src.optimizer import give_scheduler, LinearWarmupCosineAnnealingLR
-from src.utils import same_seeds, Logger, get_weight_balancing, set_param_in_device, step_params, resume_train_state, load_pretrain_model, add_tokens_tokenizer
+from src.utils import same_seeds, Logger, DataPrefetcher, get_weight_balancing, set_param_in_device, step_params, resume_train_state, load_pretrain_model, add_tokens_tokenizer
 from src.eval import val, PA_val
 # model
 from src.models.rendezvous import Rendezvous
@@ -26,49 +28,84 @@ from src.models.RIT import RiT
 from src.models.NewPA import PA
 
 # config setting
-config = EasyDict(yaml.load(open('config.yml', 'r', encoding="utf-8"), Loader=yaml.FullLoader))
+config = EasyDict(yaml.load(open('config.yml', 'r', encoding="utf-8"), Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)))
 
    
+def combined_loss(loss_functions, tool, target, verb, triplet, y1, y2, y3, y4):
+    tool_mask_loss = loss_functions['CrossEntropyLoss'](tool, y1.to(tool.dtype))
+    # labels come as (tool, verb, target, triplet), see src/txtdataloader.py
+    target_mask_loss = loss_functions['CrossEntropyLoss'](target, y3.to(target.dtype))
+    verb_mask_loss = loss_functions['CrossEntropyLoss'](verb, y2.to(verb.dtype))
+    loss_ivt    = loss_functions['BCEWithLogitsLoss'](triplet, y4.to(triplet.dtype))  
+    loss        =  tool_mask_loss + target_mask_loss + verb_mask_loss + loss_ivt 
+    return loss, tool_mask_loss, target_mask_loss, verb_mask_loss, loss_ivt
+
+# fuse the whole loss epilogue into one graph
+if config.trainer.compile:
+    combined_loss = torch.compile(combined_loss)
+
+def flush_loss_buffer(config, accelerator, loss_buf, epoch, batch, n_batches, step):
+    # only the main process logs and prints, the other ranks drop their buffer without a device sync
+    names = list(loss_buf.keys())
+    if accelerator.is_local_main_process:
+        # one device->host copy for every buffered step, then log them with their own step index
+        values = torch.stack([torch.stack(loss_buf[name]) for name in names]).float().cpu()
+        num = values.shape[1]
+        for i in range(num):
+            accelerator.log({name: float(values[j, i]) for j, name in enumerate(names)}, step=step - num + i)
+        losses = {name: float(values[j, -1]) for j, name in enumerate(names)}
+        accelerator.print(
+            f'Epoch [{epoch+1}/{config.trainer.num_epochs}][{batch + 1}/{n_batches}] Losses => total:[{losses["Train/Total Loss"]:.4f}] ivt: [{losses["Train/loss_ivt"]:.4f}] i: [{losses["Train/tool_mask_loss"]:.4f}] v: [{losses["Train/verb_mask_loss"]:.4f}] t: [{losses["Train/target_mask_loss"]:.4f}]', flush=True)
+    for name in names:
+        loss_buf[name].clear()
+
 def train_one_epoch(config, model, activation, train_loader, loss_functions, optimizer, scheduler, accelerator, epoch, step):
     # train
     model.train()
-    for batch, (img, txt, (y1, y2, y3, y4)) in enumerate(train_loader):
-        
-        tool, target, verb, triplet = model(img, txt.squeeze())
+    log_every = config.trainer.log_every
+    debug_one_batch = config.trainer.get('debug_one_batch', False)
+    n_batches = len(train_loader)
+    loss_buf = {
+        'Train/Total Loss': [],
+        'Train/tool_mask_loss': [],
+        'Train/target_mask_loss': [],
+        'Train/verb_mask_loss': [],
+        'Train/loss_ivt': [],
+    }
+    for batch, (img, txt, (y1, y2, y3, y4)) in enumerate(DataPrefetcher(train_loader, accelerator.device)):
+        img = img.contiguous(memory_format=torch.channels_last)
+        tool, target, verb, triplet = model(img, txt)
        
-        tool_mask_loss = loss_functions['CrossEntropyLoss'](tool, y1.float())
-        target_mask_loss = loss_functions['CrossEntropyLoss'](verb, y2.float())
-        verb_mask_loss = loss_functions['CrossEntropyLoss'](target, y3.float())
-        loss_ivt    = loss_functions['BCEWithLogitsLoss'](triplet, y4.float())  
-        loss        =  tool_mask_loss + target_mask_loss + verb_mask_loss + loss_ivt 
+        loss, tool_mask_loss, target_mask_loss, verb_mask_loss, loss_ivt = combined_loss(loss_functions, tool, target, verb, triplet, y1, y2, y3, y4)
 
         # lose backward
         accelerator.backward(loss)
         
         # optimizer.step
         optimizer.step()
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         
         # model.zero_grad()
         
-        # log
-        accelerator.log({
-            'Train/Total Loss': float(loss.item()),
-            'Train/tool_mask_loss': float(tool_mask_loss.item()),
-            'Train/target_mask_loss': float(target_mask_loss.item()),
-            'Train/verb_mask_loss': float(verb_mask_loss.item()),
-            'Train/loss_ivt': float(loss_ivt.item()),
-        }, step=step)
+        # log, keep losses on device and only sync every log_every steps
+        loss_buf['Train/Total Loss'].append(loss.detach())
+        loss_buf['Train/tool_mask_loss'].append(tool_mask_loss.detach())
+        loss_buf['Train/target_mask_loss'].append(target_mask_loss.detach())
+        loss_buf['Train/verb_mask_loss'].append(verb_mask_loss.detach())
+        loss_buf['Train/loss_ivt'].append(loss_ivt.detach())
         step += 1
-        accelerator.print(
-            f'Epoch [{epoch+1}/{config.trainer.num_epochs}][{batch + 1}/{len(train_loader)}] Losses => total:[{loss.item():.4f}] ivt: [{loss_ivt.item():.4f}] i: [{tool_mask_loss.item():.4f}] v: [{verb_mask_loss.item():.4f}] t: [{target_mask_loss.item():.4f}]', flush=True)
-        break
+        if (batch + 1) % log_every == 0:
+            flush_loss_buffer(config, accelerator, loss_buf, epoch, batch, n_batches, step)
+        if debug_one_batch:
+            break
+    if len(loss_buf['Train/Total Loss']) > 0:
+        flush_loss_buffer(config, accelerator, loss_buf, epoch, batch, n_batches, step)
     # learning rate schedule update
-    scheduler.step(epoch)
+    scheduler.step()
     # accelerator.print(f'[{epoch+1}/{config.trainer.num_epochs}] Epoch Losses => total:[{loss.item():.4f}] ivt: [{loss_ivt.item():.4f}] i: [{loss_i.item():.4f}] v: [{loss_v.item():.4f}] t: [{loss_t.item():.4f}]', flush=True)    
 
     if config.trainer.val_training == True:
-        metrics, _ = PA_val(config, model, train_loader, activation, step=-1, train=True)
+        metrics, _ = PA_val(config, model, DataPrefetcher(train_loader, accelerator.device), activation, step=-1, train=True)
         accelerator.log(metrics, step=epoch)
     
     return step
@@ -87,61 +124,98 @@ def val_one_epoch(config, model, val_loader, loss_functions, activation, epoch,
     return ivt_score, metrics, step
 
 if __name__ == '__main__':
+    # also turns on TF32 matmuls for the fp32 paths left outside autocast and cudnn.benchmark
     same_seeds(50)
-    logging_dir = os.getcwd() + '/logs/' + str(datetime.now())
-    accelerator = Accelerator(cpu=False, log_with=["tensorboard"], logging_dir=logging_dir)
-    Logger(logging_dir if accelerator.is_local_main_process else None)
+    cwd = os.getcwd()
+    ckpt_root = f"{cwd}/model_store/{config.finetune.checkpoint + config.trainer.dataset}"
+    best_root = f"{ckpt_root}/best"
+    best_dir = f"{best_root}/new"
+    ckpt_dir = f"{ckpt_root}/checkpoint"
+    os.makedirs(best_dir, exist_ok=True)
+    os.makedirs(ckpt_dir, exist_ok=True)
+    logging_dir = cwd + '/logs/' + str(datetime.now())
+    accelerator = Accelerator(cpu=False, mixed_precision=config.trainer.mixed_precision, log_with=["tensorboard"], logging_dir=logging_dir)
+    logger = Logger(logging_dir if accelerator.is_local_main_process else None)
     accelerator.init_trackers(os.path.split(__file__)[-1].split(".")[0])
     accelerator.print(objstr(config), flush=True)
     
-    # tokenizer and add word
-    tokenizer = AutoTokenizer.from_pretrained('bert-base-uncased')
+    # tokenizer and add word, the extended tokenizer is cached after the first run
+    base_tokenizer = 'bert-base-uncased'
     instrument_list = ['grasper', 'bipolar', 'hook', 'scissors', 'clipper', 'irrigator'] 
     target_list = ['gallbladder', 'cystic_plate', 'cystic_duct','cystic_artery', 'cystic_pedicle', 'blood_vessel', 'fluid', 'abdominal_wall_cavity', 'liver', 'adhesion', 'omentum', 'peritoneum', 'gut', 'specimen_bag', 'othertarget']       
     verb_list = ['grasp', 'retract', 'dissect', 'coagulate', 'clip', 'cut', 'aspirate', 'irrigate', 'pack', 'others']      
         
     all_list = instrument_list + target_list + verb_list
-    tokenizer = add_tokens_tokenizer(tokenizer, all_list)
+    # one cache per base model + added words, a changed all_list builds a new cache instead of reusing a stale one
+    cache_key = hashlib.sha1('\n'.join([base_tokenizer] + all_list).encode('utf-8')).hexdigest()[:12]
+    tokenizer_dir = f"{cwd}/tokenizer_cache/{base_tokenizer}-{cache_key}"
+    # the local main process builds the cache first, the other ranks only read the finished directory
+    with accelerator.local_main_process_first():
+        if not os.path.isdir(tokenizer_dir) and accelerator.is_local_main_process:
+            tokenizer = AutoTokenizer.from_pretrained(base_tokenizer)
+            tokenizer = add_tokens_tokenizer(tokenizer, all_list)
+            os.makedirs(os.path.dirname(tokenizer_dir), exist_ok=True)
+            # written to a temp dir and renamed, so an interrupted save never leaves a half-written cache
+            tmp_dir = f"{tokenizer_dir}.tmp{os.getpid()}"
+            tokenizer.save_pretrained(tmp_dir)
+            try:
+                os.replace(tmp_dir, tokenizer_dir)
+            except OSError:
+                # another node sharing cwd finished its cache first
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_dir)
     
     # load dataset
     train_loader, val_loader, test_loader = give_dataset(config.dataset.T45, tokenizer)
     
     # load model
     model = PA(tokenizer)
+    model = model.to(memory_format=torch.channels_last)
     
-    # optimizer
-    optimizer = optim_factory.create_optimizer_v2(model, opt=config.trainer.optimizer,
-                                                  weight_decay=config.trainer.weight_decay,
-                                                  lr=config.trainer.lr[0], betas=(0.9, 0.95))
-    
-    # scheduler
-    scheduler = LinearWarmupCosineAnnealingLR(optimizer, warmup_epochs=config.trainer.warmup,
-                                              max_epochs=config.trainer.num_epochs)
+    # optimizer, scheduler and loss are only needed for training
+    optimizer, scheduler, loss_functions = None, None, None
+    if config.trainer.is_train:
+        # optimizer, use the single-kernel fused Adam(W) update on GPU
+        opt_args = {'fused': True} if config.trainer.optimizer in ['adam', 'adamw'] and torch.cuda.is_available() else {}
+        optimizer = optim_factory.create_optimizer_v2(model, opt=config.trainer.optimizer,
+                                                      weight_decay=config.trainer.weight_decay,
+                                                      lr=config.trainer.lr[0], betas=(0.9, 0.95), **opt_args)
+        
+        # scheduler
+        scheduler = LinearWarmupCosineAnnealingLR(optimizer, warmup_epochs=config.trainer.warmup,
+                                                  max_epochs=config.trainer.num_epochs)
+        
+        # loss
+        loss_functions = {
+            'CrossEntropyLoss': nn.CrossEntropyLoss(),
+            'BCEWithLogitsLoss': nn.BCEWithLogitsLoss(),
+        }
     
     # activation
-    activation = nn.Sigmoid()
-    
-    # loss
-    loss_functions = {
-        'CrossEntropyLoss': nn.CrossEntropyLoss(),
-        'BCEWithLogitsLoss': nn.BCEWithLogitsLoss(),
-    }
+    activation = torch.sigmoid
     
     # training setting
     train_step = 0
     val_step = 0
     start_num_epochs = 0
-    best_score = torch.nn.Parameter(torch.tensor([0.0]), requires_grad=False)
+    best_score = 0.0
     best_metrics = {}
     
     # resume
     if config.trainer.resume.train:
         model, optimizer, scheduler, start_num_epochs, train_step, val_step, best_score, best_metrics = resume_train_state(model, config.finetune.checkpoint + config.trainer.dataset, optimizer, scheduler, accelerator)
+        best_score = float(best_score)
     if config.trainer.resume.test:
-        model = load_pretrain_model(f"{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/best/new/pytorch_model.bin", model, accelerator)
+        model = load_pretrain_model(f"{best_dir}/pytorch_model.bin", model, accelerator)
+    
+    # compile
+    if config.trainer.compile:
+        model = torch.compile(model, mode="reduce-overhead", dynamic=False)
     
     # set in device
-    model, train_loader, val_loader, optimizer, scheduler = accelerator.prepare(model, train_loader, val_loader, optimizer, scheduler)
+    # train_loader batches are moved by DataPrefetcher on a side stream, so skip accelerate's device placement for it
+    model, train_loader, val_loader, optimizer, scheduler = accelerator.prepare(model, train_loader, val_loader, optimizer, scheduler,
+                                                                                device_placement=[True, False, True, True, True])
     
     # training
     if config.trainer.is_train == True:
@@ -152,28 +226,28 @@ if __name__ == '__main__':
                 score, metrics, val_step = val_one_epoch(config, model, val_loader, loss_functions, activation, epoch, val_step)
                 
                 # save best model
-                if best_score.item() < score:
+                if best_score < score:
                     best_score = score
                     best_metrics = metrics
                     # two types of modeling saving
-                    accelerator.save_state(output_dir=f"{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/best/new/")
-                    torch.save(model.state_dict(), f"{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/best/new/model.pth")
+                    accelerator.save_state(output_dir=best_dir)
                     torch.save({'epoch': epoch, 'best_score': best_score, 'best_metrics': best_metrics, 'train_step': train_step, 'val_step': val_step},
-                            f'{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/best/epoch.pth.tar')
+                            f'{best_root}/epoch.pth.tar')
                     
                 # print best score
                 accelerator.print(f'Now best APscore: {best_score}', flush=True)
                 
                 # checkout
                 accelerator.print('Checkout....')
-                accelerator.save_state(output_dir=f"{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/checkpoint")
+                accelerator.save_state(output_dir=ckpt_dir)
                 torch.save({'epoch': epoch, 'best_score': best_score, 'best_metrics': best_metrics, 'train_step': train_step, 'val_step': val_step},
-                            f'{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/checkpoint/epoch.pth.tar')
+                            f'{ckpt_dir}/epoch.pth.tar')
                 accelerator.print('Checkout Over!')
+                logger.sync()
     
     # val
     if config.trainer.is_train != True:
-        best_score, best_metrics, val_step = val_one_epoch(config, model, val_loader, loss_functions, activation, epoch, val_step)
+        best_score, best_metrics, val_step = val_one_epoch(config, model, val_loader, loss_functions, activation, start_num_epochs, val_step)
      
     accelerator.print(f"dice ivt score: {best_score}")
     accelerator.print(f"other metrics : {best_metrics}")
@@ -17,7 +17,7 @@ from monai.utils import ensure_tuple_rep
 # src
 from src.dataloader import give_dataset
 from src.optimizer import give_scheduler
-from src.utils import same_seeds, Logger, get_weight_balancing, set_param_in_device, step_params, resume_train_state, load_pretrain_model
+from src.utils import same_seeds, Logger, get_weight_balancing, set_param_in_device, step_params, save_train_state, resume_train_state, load_pretrain_model, AsyncCheckpointer
 from src.eval import val
 # model
 from src.models.rendezvous import Rendezvous
@@ -100,7 +100,7 @@ if __name__ == '__main__':
     same_seeds(50)
     logging_dir = os.getcwd() + '/logs/' + str(datetime.now())
     accelerator = Accelerator(cpu=False, log_with=["tensorboard"], logging_dir=logging_dir)
-    Logger(logging_dir if accelerator.is_local_main_process else None)
+    logger = Logger(logging_dir if accelerator.is_local_main_process else None)
     accelerator.init_trackers(os.path.split(__file__)[-1].split(".")[0])
     accelerator.print(objstr(config), flush=True)
     
@@ -153,11 +153,11 @@ if __name__ == '__main__':
     activation = nn.Sigmoid()
     
     # load loss
-    tool_weight, verb_weight, target_weight = get_weight_balancing(config)
+    tool_weight, verb_weight, target_weight = get_weight_balancing(config, train_loader.dataset)
     loss_functions = {
-        'loss_fn_i': nn.BCEWithLogitsLoss(pos_weight=torch.tensor(tool_weight).to(accelerator.device)),
-        'loss_fn_v': nn.BCEWithLogitsLoss(pos_weight=torch.tensor(verb_weight).to(accelerator.device)),
-        'loss_fn_t': nn.BCEWithLogitsLoss(pos_weight=torch.tensor(target_weight).to(accelerator.device)),
+        'loss_fn_i': nn.BCEWithLogitsLoss(pos_weight=tool_weight.to(accelerator.device, non_blocking=True)),
+        'loss_fn_v': nn.BCEWithLogitsLoss(pos_weight=verb_weight.to(accelerator.device, non_blocking=True)),
+        'loss_fn_t': nn.BCEWithLogitsLoss(pos_weight=target_weight.to(accelerator.device, non_blocking=True)),
         'loss_fn_ivt': nn.BCEWithLogitsLoss(),
     }
     
@@ -167,6 +167,8 @@ if __name__ == '__main__':
     start_num_epochs = 0
     best_score = torch.nn.Parameter(torch.tensor([0.0]), requires_grad=False)
     best_metrics = {}
+    # model.pth is written in the background while the next epoch trains
+    checkpointer = AsyncCheckpointer()
     
     
     # resume
@@ -193,8 +195,8 @@ if __name__ == '__main__':
                 best_score = score
                 best_metrics = metrics
                 # two types of modeling saving
-                accelerator.save_state(output_dir=f"{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/best/new/")
-                torch.save(model.state_dict(), f"{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/best/new/model.pth")
+                save_train_state(f"{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/best/new/", model, optimizers, schedulers, accelerator)
+                checkpointer.save(model.state_dict(), f"{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/best/new/model.pth")
                 torch.save({'epoch': epoch, 'best_score': best_score, 'best_metrics': best_metrics, 'train_step': train_step, 'val_step': val_step},
                         f'{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/best/epoch.pth.tar')
                 
@@ -203,10 +205,11 @@ if __name__ == '__main__':
             
             # checkout
             accelerator.print('Checkout....')
-            accelerator.save_state(output_dir=f"{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/checkpoint")
+            save_train_state(f"{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/checkpoint", model, optimizers, schedulers, accelerator)
             torch.save({'epoch': epoch, 'best_score': best_score, 'best_metrics': best_metrics, 'train_step': train_step, 'val_step': val_step},
                         f'{os.getcwd()}/model_store/{config.finetune.checkpoint + config.trainer.dataset}/checkpoint/epoch.pth.tar')
             accelerator.print('Checkout Over!')
+            logger.sync()
     
     # val
     if config.trainer.is_train != True:
@@ -214,4 +217,5 @@ if __name__ == '__main__':
      
     accelerator.print(f"dice ivt score: {best_score}")
     accelerator.print(f"other metrics : {best_metrics}")
+    checkpointer.wait()
     sys.exit(1) 
\ No newline at end of file
@@ -1,3 +1,4 @@
+import torch
 import ivtmetrics
 
 def val(config, model, dataloader, activation, step=0, train=False):
@@ -19,6 +20,7 @@ def val(config, model, dataloader, activation, step=0, train=False):
         if config.trainer.dataset == 'T50':
             b, m, c, h, w = img.size()
             img = img.view(-1, c, h, w)
+        img = img.contiguous(memory_format=torch.channels_last)
         _, _, _, triplet = model(img)
         
         logit_ivt  = triplet  
@@ -63,6 +65,7 @@ def val(config, model, dataloader, activation, step=0, train=False):
     return metrics, step
 
 
+@torch.inference_mode()
 def PA_val(config, model, dataloader, activation, step=0, train=False):
     model.eval()
     data_choose = config.trainer.dataset
@@ -82,7 +85,8 @@ def PA_val(config, model, dataloader, activation, step=0, train=False):
         if config.trainer.dataset == 'T50':
             b, m, c, h, w = img.size()
             img = img.view(-1, c, h, w)
-        _, _, _, triplet = model(img, txt.squeeze())
+        img = img.contiguous(memory_format=torch.channels_last)
+        _, _, _, triplet = model(img, txt)
         
         logit_ivt  = triplet  
         if config.trainer.dataset == 'T50':
@@ -0,0 +1,88 @@
+"""
+Export EndoForm at the fixed (1, 3, 256, 448) input shape to a frozen TorchScript module and / or ONNX
+both are traced with static shapes, so every resize / reshape size is folded into a constant
+
+    python -m src.export --checkpoint model_store/<checkpoint>/best/new/model.pth --onnx
+"""
+import os
+import argparse
+
+import torch
+from torch import nn
+
+from src.models.EndoForm import EndoForm, FusedLayerNorm
+from src.utils import PrefixStrippedStateDict, load_model_dict
+
+OUTPUT_NAMES = ['tool', 'verb', 'target', 'triplet']
+
+
+def plain_layernorm(model):
+    """
+    swap apex FusedLayerNorm for nn.LayerNorm, the fused kernel is neither traceable nor ONNX exportable
+    """
+    if FusedLayerNorm is nn.LayerNorm:
+        return model
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, FusedLayerNorm):
+                norm = nn.LayerNorm(child.normalized_shape, eps=child.eps, elementwise_affine=child.elementwise_affine)
+                norm.load_state_dict(child.state_dict())
+                setattr(module, name, norm)
+    return model
+
+
+def build_model(checkpoint, device, conv_norm=False):
+    # fp32, eager blocks and no side streams: the trace records plain ops only
+    model = EndoForm(in_channels=3, amp_dtype=None, compile_blocks=False, use_side_streams=False, conv_norm=conv_norm)
+    if checkpoint:
+        model.load_state_dict(PrefixStrippedStateDict(load_model_dict(checkpoint)))
+    return plain_layernorm(model).to(device).eval().reparameterize()
+
+
+def check_outputs(name, expected, outputs, atol):
+    for out_name, ref, out in zip(OUTPUT_NAMES, expected, outputs):
+        diff = (ref.float().cpu() - torch.as_tensor(out).float().cpu()).abs().max().item()
+        print(f'{name} {out_name}: max abs diff {diff:.2e}')
+        assert diff <= atol, f'{name} {out_name} differs from eager by {diff:.2e} > {atol}'
+
+
+@torch.no_grad()
+def export_torchscript(model, x, path, atol=1e-3):
+    traced = torch.jit.freeze(torch.jit.trace(model, x))
+    traced.save(path)
+    check_outputs('torchscript', model(x), traced(x), atol)
+    return traced
+
+
+@torch.no_grad()
+def export_onnx(model, x, path, opset=17, atol=1e-3):
+    # dynamic_axes=None: static shapes, Upsample stays bilinear (4D Resize), no trilinear
+    torch.onnx.export(model, (x,), path, opset_version=opset, do_constant_folding=True,
+                      input_names=['img'], output_names=OUTPUT_NAMES, dynamic_axes=None)
+    try:
+        import onnxruntime
+    except ImportError:
+        print('onnxruntime is not installed, skip checking the ONNX outputs')
+        return
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    check_outputs('onnx', model(x), session.run(None, {'img': x.cpu().numpy()}), atol)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', default='', help='model.pth / pytorch_model.bin, empty exports the initial weights')
+    parser.add_argument('--out_dir', default=f'{os.getcwd()}/model_store/export')
+    parser.add_argument('--device', default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--conv_norm', action='store_true', help='the checkpoint was trained with trainer.conv_norm')
+    parser.add_argument('--onnx', action='store_true')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--atol', type=float, default=1e-3)
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    model = build_model(args.checkpoint, args.device, args.conv_norm)
+    x = torch.randn(size=(1, 3, 256, 448), device=args.device).contiguous(memory_format=torch.channels_last)
+
+    export_torchscript(model, x, f'{args.out_dir}/endoform.pt', args.atol)
+    if args.onnx:
+        export_onnx(model, x, f'{args.out_dir}/endoform.onnx', args.opset, args.atol)
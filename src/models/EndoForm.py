@@ -8,14 +8,34 @@ import torch.nn.functional as F
 from timm.models.registry import register_model
 from mmengine.model import constant_init, kaiming_init
 from timm.models.layers import DropPath, to_2tuple, make_divisible, trunc_normal_
+try:
+    from apex.normalization import FusedLayerNorm
+except ImportError:
+    FusedLayerNorm = nn.LayerNorm
+
 warnings.filterwarnings('ignore')
 
 
+def _pvt_init_weights(m):
+    if isinstance(m, nn.Linear):
+        trunc_normal_(m.weight, std=.02)
+        if m.bias is not None:
+            nn.init.constant_(m.bias, 0)
+    elif isinstance(m, nn.LayerNorm):
+        nn.init.constant_(m.bias, 0)
+        nn.init.constant_(m.weight, 1.0)
+    elif isinstance(m, nn.Conv2d):
+        fan_out = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
+        fan_out //= m.groups
+        m.weight.data.normal_(0, math.sqrt(2.0 / fan_out))
+        if m.bias is not None:
+            m.bias.data.zero_()
+
 class OverlapPatchEmbed(nn.Module):
     """ Image to Patch Embedding
     """
 
-    def __init__(self, img_size=224, patch_size=7, stride=4, in_chans=3, embed_dim=768):
+    def __init__(self, img_size=224, patch_size=7, stride=4, in_chans=3, embed_dim=768, conv_norm=False):
         super().__init__()
         img_size = to_2tuple(img_size)
         patch_size = to_2tuple(patch_size)
@@ -26,43 +46,47 @@ class OverlapPatchEmbed(nn.Module):
         self.num_patches = self.H * self.W
         self.proj = nn.Conv2d(in_chans, embed_dim, kernel_size=patch_size, stride=stride,
                               padding=(patch_size[0] // 2, patch_size[1] // 2))
-        self.norm = nn.LayerNorm(embed_dim)
-
-        self.apply(self._init_weights)
-
-    def _init_weights(self, m):
-        if isinstance(m, nn.Linear):
-            trunc_normal_(m.weight, std=.02)
-            if isinstance(m, nn.Linear) and m.bias is not None:
-                nn.init.constant_(m.bias, 0)
-        elif isinstance(m, nn.LayerNorm):
-            nn.init.constant_(m.bias, 0)
-            nn.init.constant_(m.weight, 1.0)
-        elif isinstance(m, nn.Conv2d):
-            fan_out = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
-            fan_out //= m.groups
-            m.weight.data.normal_(0, math.sqrt(2.0 / fan_out))
-            if m.bias is not None:
-                m.bias.data.zero_()
+        # conv_norm: BN on the NCHW conv output instead of LN on the tokens, it can be folded into proj by fuse()
+        self.conv_norm = conv_norm
+        self.norm = nn.BatchNorm2d(embed_dim) if conv_norm else nn.LayerNorm(embed_dim)
 
     def forward(self, x):
         x = self.proj(x)
-        _, _, H, W = x.shape
-        x = x.flatten(2).transpose(1, 2)
-        x = self.norm(x)
+        if self.conv_norm:
+            x = self.norm(x)
+            _, _, H, W = x.shape
+            x = x.flatten(2).transpose(1, 2)
+        else:
+            _, _, H, W = x.shape
+            x = x.flatten(2).transpose(1, 2)
+            x = self.norm(x)
 
         return x, H, W
 
+    @torch.no_grad()
+    def fuse(self):
+        """
+        Fold the BatchNorm2d into proj, call after model.eval(), the LayerNorm variant is left as it is
+        """
+        if not self.conv_norm or isinstance(self.norm, nn.Identity):
+            return self.proj
+        weight, bias = fuse_conv_bn(self.proj, self.norm)
+        self.proj.weight.copy_(weight)
+        if self.proj.bias is None:
+            self.proj.bias = nn.Parameter(bias)
+        else:
+            self.proj.bias.copy_(bias)
+        self.norm = nn.Identity()
+        return self.proj
+
 class DWConv(nn.Module):
     def __init__(self, dim=768):
         super(DWConv, self).__init__()
         self.dwconv = nn.Conv2d(dim, dim, 3, 1, 1, bias=True, groups=dim)
 
-    def forward(self, x, H, W):
-        B, N, C = x.shape
-        x = x.transpose(1, 2).view(B, C, H, W)
+    def forward(self, x):
+        # x: [B, C, H, W]
         x = self.dwconv(x)
-        x = x.flatten(2).transpose(1, 2)
 
         return x
 
@@ -76,8 +100,12 @@ class Attention(nn.Module):
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim ** -0.5
 
-        self.q = nn.Linear(dim, dim, bias=qkv_bias)
-        self.kv = nn.Linear(dim, dim * 2, bias=qkv_bias)
+        if sr_ratio > 1:
+            self.q = nn.Linear(dim, dim, bias=qkv_bias)
+            self.kv = nn.Linear(dim, dim * 2, bias=qkv_bias)
+        else:
+            # q, k, v all read x, project them with one GEMM
+            self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
@@ -87,41 +115,53 @@ class Attention(nn.Module):
             self.sr = nn.Conv2d(dim, dim, kernel_size=sr_ratio, stride=sr_ratio)
             self.norm = nn.LayerNorm(dim)
 
-        self.apply(self._init_weights)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # pretrained PVT checkpoints keep q and kv apart, merge them into qkv
+        if self.sr_ratio == 1 and prefix + 'q.weight' in state_dict:
+            for name in ['weight', 'bias']:
+                if prefix + f'q.{name}' in state_dict:
+                    state_dict[prefix + f'qkv.{name}'] = torch.cat([state_dict.pop(prefix + f'q.{name}'),
+                                                                  state_dict.pop(prefix + f'kv.{name}')], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-    def _init_weights(self, m):
-        if isinstance(m, nn.Linear):
-            trunc_normal_(m.weight, std=.02)
-            if isinstance(m, nn.Linear) and m.bias is not None:
-                nn.init.constant_(m.bias, 0)
-        elif isinstance(m, nn.LayerNorm):
-            nn.init.constant_(m.bias, 0)
-            nn.init.constant_(m.weight, 1.0)
-        elif isinstance(m, nn.Conv2d):
-            fan_out = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
-            fan_out //= m.groups
-            m.weight.data.normal_(0, math.sqrt(2.0 / fan_out))
-            if m.bias is not None:
-                m.bias.data.zero_()
+    @torch.no_grad()
+    def fuse(self):
+        """
+        Fold the sr-branch LayerNorm affine into kv, call after model.eval()
+        sr and kv can not be merged into one conv, the LayerNorm normalization between them is not linear
+        """
+        if self.sr_ratio == 1 or not isinstance(self.kv, nn.Linear) or not self.norm.elementwise_affine:
+            return self
+        # kv(gamma * x_hat + beta) = (kv.weight * gamma) @ x_hat + (kv.weight @ beta + kv.bias)
+        bias = self.kv.weight @ self.norm.bias
+        if self.kv.bias is not None:
+            bias = bias + self.kv.bias
+        self.kv.weight.mul_(self.norm.weight[None, :])
+        if self.kv.bias is None:
+            self.kv.bias = nn.Parameter(bias)
+        else:
+            self.kv.bias.copy_(bias)
+        self.norm = nn.LayerNorm(self.dim, eps=self.norm.eps, elementwise_affine=False).to(bias.device)
+        return self
 
     def forward(self, x, H, W):
         B, N, C = x.shape
-        q = self.q(x).reshape(B, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
 
         if self.sr_ratio > 1:
-            x_ = x.permute(0, 2, 1).reshape(B, C, H, W)
+            q = self.q(x).reshape(B, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
+            # [B, N, C] tokens are an NHWC view already, no copy when kept channels_last
+            x_ = x.permute(0, 2, 1).reshape(B, C, H, W).contiguous(memory_format=torch.channels_last)
             x_ = self.sr(x_).reshape(B, C, -1).permute(0, 2, 1)
             x_ = self.norm(x_)
             kv = self.kv(x_).reshape(B, -1, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+            k, v = kv[0], kv[1]
         else:
-            kv = self.kv(x).reshape(B, -1, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
-        k, v = kv[0], kv[1]
+            qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+            q, k, v = qkv[0], qkv[1], qkv[2]
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        # fused softmax(q @ k^T * scale) @ v, dispatches to flash / memory-efficient kernels
+        x = F.scaled_dot_product_attention(q, k, v, dropout_p=self.attn_drop.p if self.training else 0.0, scale=self.scale)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
 
@@ -138,32 +178,31 @@ class Mlp(nn.Module):
         self.fc2 = nn.Linear(hidden_features, out_features)
         self.drop = nn.Dropout(drop)
 
-        self.apply(self._init_weights)
-
-    def _init_weights(self, m):
-        if isinstance(m, nn.Linear):
-            trunc_normal_(m.weight, std=.02)
-            if isinstance(m, nn.Linear) and m.bias is not None:
-                nn.init.constant_(m.bias, 0)
-        elif isinstance(m, nn.LayerNorm):
-            nn.init.constant_(m.bias, 0)
-            nn.init.constant_(m.weight, 1.0)
-        elif isinstance(m, nn.Conv2d):
-            fan_out = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
-            fan_out //= m.groups
-            m.weight.data.normal_(0, math.sqrt(2.0 / fan_out))
-            if m.bias is not None:
-                m.bias.data.zero_()
-
     def forward(self, x, H, W):
-        x = self.fc1(x)
-        x = self.dwconv(x, H, W)
+        B, N, C = x.shape
+        # stay in [B, C, H, W] for the whole MLP, fc1/fc2 run as 1x1 convs on their Linear weights
+        # so only the narrow input/output is transposed, not the mlp_ratio times wider hidden tensor
+        x = x.transpose(1, 2).reshape(B, C, H, W).contiguous(memory_format=torch.channels_last)
+        x = F.conv2d(x, self.fc1.weight[:, :, None, None], self.fc1.bias)
+        x = self.dwconv(x)
         x = self.act(x)
         x = self.drop(x)
-        x = self.fc2(x)
+        x = F.conv2d(x, self.fc2.weight[:, :, None, None], self.fc2.bias)
         x = self.drop(x)
+        x = x.flatten(2).transpose(1, 2)
         return x
 
+class FastDropPath(DropPath):
+    """ timm DropPath without the helper call, eval / zero rate return x untouched so compiled Blocks stay one graph
+    """
+
+    def forward(self, x):
+        if not self.training or self.drop_prob == 0.:
+            return x
+        keep_prob = 1 - self.drop_prob
+        mask = x.new_empty((x.shape[0],) + (1,) * (x.ndim - 1)).bernoulli_(keep_prob)
+        return x * mask.div_(keep_prob)
+
 class Block(nn.Module):
 
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
@@ -175,28 +214,11 @@ class Block(nn.Module):
             num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale,
             attn_drop=attn_drop, proj_drop=drop, sr_ratio=sr_ratio)
         # NOTE: drop path for stochastic depth, we shall see if this is better than dropout here
-        self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
+        self.drop_path = FastDropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-        self.apply(self._init_weights)
-
-    def _init_weights(self, m):
-        if isinstance(m, nn.Linear):
-            trunc_normal_(m.weight, std=.02)
-            if isinstance(m, nn.Linear) and m.bias is not None:
-                nn.init.constant_(m.bias, 0)
-        elif isinstance(m, nn.LayerNorm):
-            nn.init.constant_(m.bias, 0)
-            nn.init.constant_(m.weight, 1.0)
-        elif isinstance(m, nn.Conv2d):
-            fan_out = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
-            fan_out //= m.groups
-            m.weight.data.normal_(0, math.sqrt(2.0 / fan_out))
-            if m.bias is not None:
-                m.bias.data.zero_()
-
     def forward(self, x, H, W):
         x = x + self.drop_path(self.attn(self.norm1(x), H, W))
         x = x + self.drop_path(self.mlp(self.norm2(x), H, W))
@@ -207,23 +229,23 @@ class PyramidVisionTransformerImpr(nn.Module):
     def __init__(self, img_size=224, patch_size=16, in_chans=3, num_classes=1000, embed_dims=[64, 128, 256, 512],
                  num_heads=[1, 2, 4, 8], mlp_ratios=[4, 4, 4, 4], qkv_bias=False, qk_scale=None, drop_rate=0.,
                  attn_drop_rate=0., drop_path_rate=0., norm_layer=nn.LayerNorm,
-                 depths=[3, 4, 6, 3], sr_ratios=[8, 4, 2, 1]):
+                 depths=[3, 4, 6, 3], sr_ratios=[8, 4, 2, 1], compile_blocks=False, conv_norm=False):
         super().__init__()
         self.num_classes = num_classes
         self.depths = depths
 
         # patch_embed
         self.patch_embed1 = OverlapPatchEmbed(img_size=img_size, patch_size=7, stride=4, in_chans=in_chans,
-                                              embed_dim=embed_dims[0])
+                                              embed_dim=embed_dims[0], conv_norm=conv_norm)
         self.patch_embed2 = OverlapPatchEmbed(img_size=img_size // 4, patch_size=3, stride=2, in_chans=embed_dims[0],
-                                              embed_dim=embed_dims[1])
+                                              embed_dim=embed_dims[1], conv_norm=conv_norm)
         self.patch_embed3 = OverlapPatchEmbed(img_size=img_size // 8, patch_size=3, stride=2, in_chans=embed_dims[1],
-                                              embed_dim=embed_dims[2])
+                                              embed_dim=embed_dims[2], conv_norm=conv_norm)
         self.patch_embed4 = OverlapPatchEmbed(img_size=img_size // 16, patch_size=3, stride=2, in_chans=embed_dims[2],
-                                              embed_dim=embed_dims[3])
+                                              embed_dim=embed_dims[3], conv_norm=conv_norm)
 
         # transformer encoder
-        dpr = [x.item() for x in torch.linspace(0, drop_path_rate, sum(depths))]  # stochastic depth decay rule
+        dpr = torch.linspace(0, drop_path_rate, sum(depths)).tolist()  # stochastic depth decay rule
         cur = 0
         self.block1 = nn.ModuleList([Block(
             dim=embed_dims[0], num_heads=num_heads[0], mlp_ratio=mlp_ratios[0], qkv_bias=qkv_bias, qk_scale=qk_scale,
@@ -256,22 +278,14 @@ class PyramidVisionTransformerImpr(nn.Module):
             for i in range(depths[3])])
         self.norm4 = norm_layer(embed_dims[3])
 
-        self.apply(self._init_weights)
+        # the submodules do not init themselves, every Linear / LayerNorm / Conv2d is initialized once here
+        self.apply(_pvt_init_weights)
 
-    def _init_weights(self, m):
-        if isinstance(m, nn.Linear):
-            trunc_normal_(m.weight, std=.02)
-            if isinstance(m, nn.Linear) and m.bias is not None:
-                nn.init.constant_(m.bias, 0)
-        elif isinstance(m, nn.LayerNorm):
-            nn.init.constant_(m.bias, 0)
-            nn.init.constant_(m.weight, 1.0)
-        elif isinstance(m, nn.Conv2d):
-            fan_out = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
-            fan_out //= m.groups
-            m.weight.data.normal_(0, math.sqrt(2.0 / fan_out))
-            if m.bias is not None:
-                m.bias.data.zero_()
+        # fuse norm + attn + residual + norm + mlp + residual of every Block, compiled in place so state dict keys stay the same
+        if compile_blocks:
+            for blocks in [self.block1, self.block2, self.block3, self.block4]:
+                for blk in blocks:
+                    blk.compile(mode="reduce-overhead", dynamic=True)
 
     def init_weights(self, pretrained=None):
         if isinstance(pretrained, str):
@@ -279,7 +293,7 @@ class PyramidVisionTransformerImpr(nn.Module):
             #load_checkpoint(self, pretrained, map_location='cpu', strict=False, logger=logger)
 
     def reset_drop_path(self, drop_path_rate):
-        dpr = [x.item() for x in torch.linspace(0, drop_path_rate, sum(self.depths))]
+        dpr = torch.linspace(0, drop_path_rate, sum(self.depths)).tolist()
         cur = 0
         for i in range(self.depths[0]):
             self.block1[i].drop_path.drop_prob = dpr[cur + i]
@@ -299,7 +313,6 @@ class PyramidVisionTransformerImpr(nn.Module):
     def freeze_patch_emb(self):
         self.patch_embed1.requires_grad = False
 
-    @torch.jit.ignore
     def no_weight_decay(self):
         return {'pos_embed1', 'pos_embed2', 'pos_embed3', 'pos_embed4', 'cls_token'}  # has pos_embed may be better
 
@@ -314,12 +327,13 @@ class PyramidVisionTransformerImpr(nn.Module):
         B = x.shape[0]
         outs = []
 
+        # the [B, H, W, C] -> [B, C, H, W] permute of the tokens is already channels_last, keep it as a view instead of an NCHW copy
         # stage 1
         x, H, W = self.patch_embed1(x)
         for i, blk in enumerate(self.block1):
             x = blk(x, H, W)
         x = self.norm1(x)
-        x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2).contiguous()
+        x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2).contiguous(memory_format=torch.channels_last)
         outs.append(x)
 
         # stage 2
@@ -327,7 +341,7 @@ class PyramidVisionTransformerImpr(nn.Module):
         for i, blk in enumerate(self.block2):
             x = blk(x, H, W)
         x = self.norm2(x)
-        x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2).contiguous()
+        x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2).contiguous(memory_format=torch.channels_last)
         outs.append(x)
 
         # stage 3
@@ -335,7 +349,7 @@ class PyramidVisionTransformerImpr(nn.Module):
         for i, blk in enumerate(self.block3):
             x = blk(x, H, W)
         x = self.norm3(x)
-        x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2).contiguous()
+        x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2).contiguous(memory_format=torch.channels_last)
         outs.append(x)
 
         # stage 4
@@ -343,7 +357,7 @@ class PyramidVisionTransformerImpr(nn.Module):
         for i, blk in enumerate(self.block4):
             x = blk(x, H, W)
         x = self.norm4(x)
-        x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2).contiguous()
+        x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2).contiguous(memory_format=torch.channels_last)
         outs.append(x)
 
         return outs
@@ -355,28 +369,31 @@ class PyramidVisionTransformerImpr(nn.Module):
 
 @register_model
 class pvt_v2_b2(PyramidVisionTransformerImpr):
-    def __init__(self,in_chans=3, embed_dims= [64, 128, 320, 512], **kwargs):
+    def __init__(self,in_chans=3, embed_dims= [64, 128, 320, 512], compile_blocks=False, conv_norm=False, fused_norm=True, **kwargs):
         super(pvt_v2_b2, self).__init__(
             in_chans=in_chans,patch_size=4, embed_dims=embed_dims, num_heads=[1, 2, 5, 8], mlp_ratios=[8, 8, 4, 4], 
-            qkv_bias=True, norm_layer=partial(nn.LayerNorm, eps=1e-6), depths=[3, 4, 6, 3], sr_ratios=[8, 4, 2, 1],
-            drop_rate=0.0, drop_path_rate=0.1)
-
+            # compiled Blocks (or a compiled model) get LN + residual fused by inductor, apex's kernel would only add graph breaks there
+            qkv_bias=True, norm_layer=partial(FusedLayerNorm if fused_norm and not compile_blocks else nn.LayerNorm, eps=1e-6), depths=[3, 4, 6, 3], sr_ratios=[8, 4, 2, 1],
+            drop_rate=0.0, drop_path_rate=0.1, compile_blocks=compile_blocks, conv_norm=conv_norm)
 
-class SwishImplementation(torch.autograd.Function):
-    @staticmethod
-    def forward(ctx, i):
-        ctx.save_for_backward(i)
-        return i * torch.sigmoid(i)
 
-    @staticmethod
-    def backward(ctx, grad_output):
-        sigmoid_i = torch.sigmoid(ctx.saved_variables[0])
-        return grad_output * (sigmoid_i * (1 + ctx.saved_variables[0] * (1 - sigmoid_i)))
+# Swish激活函数, x * sigmoid(x) == SiLU, the native kernel can be fused by torch.compile
+class Swish(nn.SiLU):
+    pass
 
-# Swish激活函数
-class Swish(nn.Module):
-    def forward(self, x):
-        return SwishImplementation.apply(x)
+def fuse_conv_bn(conv, bn):
+    """
+    Fold an eval-mode BatchNorm2d into the preceding conv, return the fused (weight, bias) in conv.weight.dtype
+    computed in at least fp32, so a bf16 / fp16 conv is only rounded once
+    """
+    dtype = torch.promote_types(conv.weight.dtype, torch.float32)
+    std = (bn.running_var.to(dtype) + bn.eps).sqrt()
+    scale = bn.weight.to(dtype) / std
+    weight = conv.weight.to(dtype) * scale.reshape(-1, 1, 1, 1)
+    bias = bn.bias.to(dtype) - bn.running_mean.to(dtype) * scale
+    if conv.bias is not None:
+        bias = bias + conv.bias.to(dtype) * scale
+    return weight.to(conv.weight.dtype), bias.to(conv.weight.dtype)
 
 class MLP(nn.Module):
     def __init__(self, dim, mlp_ratio, act):
@@ -405,6 +422,24 @@ class BasicConv2d(nn.Module):
         x = self.bn(x)
         x = self.act(x)
         return x
+
+    @torch.no_grad()
+    def fuse(self):
+        """
+        Fold bn into conv, call after model.eval(), cudnn.benchmark (same_seeds) then picks the conv+bias+act kernels
+        """
+        if isinstance(self.bn, nn.Identity):
+            return self.conv
+        weight, bias = fuse_conv_bn(self.conv, self.bn)
+        conv = self.conv
+        # same padding_mode / groups / dilation, device and dtype as the unfused conv, only a bias is added
+        self.conv = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding,
+                              conv.dilation, conv.groups, bias=True, padding_mode=conv.padding_mode,
+                              device=conv.weight.device, dtype=conv.weight.dtype).to(memory_format=torch.channels_last)
+        self.conv.weight.copy_(weight)
+        self.conv.bias.copy_(bias)
+        self.bn = nn.Identity()
+        return self.conv
    
 
 class SEModule(nn.Module):
@@ -474,7 +509,10 @@ class GobleAttention(nn.Module):
         # keep input
         identity = x
         # 多重计算
-        x = self.base_norm(self.base_conv(x)) + self.add_norm(self.add_conv(x)) + x
+        if hasattr(self, 'rep_conv'):
+            x = self.rep_conv(x)
+        else:
+            x = self.base_norm(self.base_conv(x)) + self.add_norm(self.add_conv(x)) + x
         # # SE
         # x = self.se(x)
         x = self.mlp(x)
@@ -482,27 +520,28 @@ class GobleAttention(nn.Module):
     
     @torch.no_grad()
     def fuse(self):
-        conv = self.conv.fuse()
-        conv1 = self.conv1.fuse()
-
-        conv_w = conv.weight
-        conv_b = conv.bias
-        conv1_w = conv1.weight
-        conv1_b = conv1.bias
-
-        conv1_w = nn.functional.pad(conv1_w, [1, 1, 1, 1])
+        """
+        Re-parameterize base_conv+BN, add_conv+BN and the identity into one depthwise conv, call after model.eval()
+        """
+        if hasattr(self, 'rep_conv'):
+            return self.rep_conv
+        base_w, base_b = fuse_conv_bn(self.base_conv, self.base_norm)
+        add_w, add_b = fuse_conv_bn(self.add_conv, self.add_norm)
 
-        identity = nn.functional.pad(
-            torch.ones(conv1_w.shape[0], conv1_w.shape[1], 1, 1, device=conv1_w.device),
-            [1, 1, 1, 1],
-        )
+        # 1x1 -> kxk, and the identity as a one at the kernel center of every channel
+        pad = (self.base_conv.kernel_size[0] - 1) // 2
+        add_w = F.pad(add_w, [pad, pad, pad, pad])
+        identity = F.pad(torch.ones_like(self.add_conv.weight), [pad, pad, pad, pad])
 
-        final_conv_w = conv_w + conv1_w + identity
-        final_conv_b = conv_b + conv1_b
+        out_dim = self.base_conv.out_channels
+        rep_conv = nn.Conv2d(out_dim, out_dim, self.base_conv.kernel_size, 1, pad, 1, out_dim, bias=True,
+                             device=base_w.device, dtype=base_w.dtype).to(memory_format=torch.channels_last)
+        rep_conv.weight.copy_(base_w + add_w + identity)
+        rep_conv.bias.copy_(base_b + add_b)
 
-        conv.weight.data.copy_(final_conv_w)
-        conv.bias.data.copy_(final_conv_b)
-        return conv
+        self.rep_conv = rep_conv
+        del self.base_conv, self.base_norm, self.add_conv, self.add_norm
+        return rep_conv
 
 
 class LocalAttention(nn.Module):
@@ -549,12 +588,13 @@ class GlobalSparseTransformer(nn.Module):
         self.head_dim = channels // heads
         self.scale = self.head_dim ** -0.5
         self.num_heads = heads
-        self.sparse_sampler = nn.AvgPool2d(kernel_size=1, stride=r)
+        # a kernel_size=1 pool with stride r is plain strided subsampling, done as a slice in forward
+        self.r = r
         # qkv
         self.qkv = nn.Conv2d(channels, channels * 3, kernel_size=1, bias=False)
 
     def forward(self, x):
-        x = self.sparse_sampler(x)
+        x = x[:, :, ::self.r, ::self.r]
         B, C, H, W = x.shape
         q, k, v = self.qkv(x).view(B, self.num_heads, -1, H * W ).split(
             [self.head_dim, self.head_dim, self.head_dim],
@@ -605,23 +645,33 @@ class CrossAttention(nn.Module):
         self.value_conv = nn.Conv2d(feature_dim, feature_dim, kernel_size=1)
         self.gamma = nn.Parameter(torch.zeros(1))
 
-    def forward(self, x1, x2):
-        # 计算query、key、value
-        query = self.query_conv(x1)
-        key = self.key_conv(x2)
-        value = self.value_conv(x2)
-        
-        # 计算注意力分数
-        attention = torch.matmul(query.permute(0, 2, 3, 1), key.permute(0, 2, 3, 1).transpose(-1, -2))
-        attention = F.softmax(attention, dim=-1)
-        
-        # 应用注意力权重
-        out = torch.matmul(attention, value.permute(0, 2, 3, 1))
-        out = out.permute(0, 3, 1, 2)
-        
+    @staticmethod
+    def _tokens(x):
+        # (B, C', H, W) -> (B, 1, H*W, C'), single head attention over all positions
+        return x.flatten(2).transpose(1, 2).unsqueeze(1)
+
+    def project(self, x):
+        """
+        query、key、value of one input, so both directions of a siamese pair can reuse them
+        """
+        return self._tokens(self.query_conv(x)), self._tokens(self.key_conv(x)), self._tokens(self.value_conv(x))
+
+    def attend(self, query, key, value, residual):
+        B, C, H, W = residual.shape
+        # 计算并应用注意力权重, unscaled logits as before
+        out = F.scaled_dot_product_attention(query, key, value, scale=1.0)
+        out = out.squeeze(1).transpose(1, 2).reshape(B, C, H, W)
+
         # 缩放和残差连接
-        out = self.gamma * out + x1
+        out = self.gamma * out + residual
         return out
+
+    def forward(self, x1, x2):
+        # 计算query、key、value
+        query = self._tokens(self.query_conv(x1))
+        key = self._tokens(self.key_conv(x2))
+        value = self._tokens(self.value_conv(x2))
+        return self.attend(query, key, value, x1)
     
 class SiameseNetworkWithCrossAttention(nn.Module):
     def __init__(self, input_channels, output_dim1, output_dim2):
@@ -642,9 +692,11 @@ class SiameseNetworkWithCrossAttention(nn.Module):
         shared_features1 = self.shared_conv(img1)
         shared_features2 = self.shared_conv(img2)
         
-        # 应用交叉注意力
-        attended_features1 = self.cross_attention(shared_features1, shared_features2)
-        attended_features2 = self.cross_attention(shared_features2, shared_features1)
+        # 应用交叉注意力, each input is projected once and used in both directions
+        q1, k1, v1 = self.cross_attention.project(shared_features1)
+        q2, k2, v2 = self.cross_attention.project(shared_features2)
+        attended_features1 = self.cross_attention.attend(q1, k2, v2, shared_features1)
+        attended_features2 = self.cross_attention.attend(q2, k1, v1, shared_features2)
         
         # 全局平均池化
         pooled_features1 = F.adaptive_avg_pool2d(attended_features1, (1, 1))
@@ -681,11 +733,12 @@ class AttentionClassifier(nn.Module):
         t_num = target.size()[-1] # 15
         v_num = verb.size()[-1] # 10
         
-        query = instrument.repeat(1, 1, v_num).view(-1, i_num * v_num)
+        # tile each sample's scores n times as broadcast views, [a, b, c] -> [a, b, c, a, b, c, ...]
+        query = instrument.unsqueeze(-2).expand(-1, v_num, -1).reshape(-1, i_num * v_num)
         # query = self.instrument_shape_layer(query)
-        key = target.repeat(1, 1, v_num).view(-1, t_num * v_num)
+        key = target.unsqueeze(-2).expand(-1, v_num, -1).reshape(-1, t_num * v_num)
         # key = self.target_shape_layer(key)
-        value = verb.repeat(1, i_num, 1).view(-1, v_num * i_num)
+        value = verb.unsqueeze(-2).expand(-1, i_num, -1).reshape(-1, v_num * i_num)
         # value = self.verb_shape_layer(value)
         
         batch_size = query.size(0)
@@ -695,13 +748,8 @@ class AttentionClassifier(nn.Module):
         key = self.key_proj(key).view(batch_size, -1, self.num_heads, self.head_dim).transpose(1, 2)
         value = self.value_proj(value).view(batch_size, -1, self.num_heads, self.head_dim).transpose(1, 2)
 
-        # Compute the attention scores
-        scores = torch.matmul(query, key.transpose(-2, -1)) / math.sqrt(self.head_dim)
-        
-        attention = F.softmax(scores, dim=-1)
-
-        # Aggregate the values
-        out = torch.matmul(attention, value)
+        # Compute the attention scores and aggregate the values in one fused call, scale defaults to 1 / sqrt(head_dim)
+        out = F.scaled_dot_product_attention(query, key, value)
         out = out.transpose(1, 2).contiguous().view(batch_size, -1, self.num_heads * self.head_dim)
         
         out = self.mlp(out.squeeze(1))
@@ -709,16 +757,21 @@ class AttentionClassifier(nn.Module):
 
    
 class EndoForm(nn.Module):
-    def __init__(self, in_channels=3, total_channels = 100, i_channels=6, t_channels=15, v_channels=10, num_heads=10, dims=[64, 128, 320, 512], out_dim=32, kernel_size=3, mlp_ratio=4, model_dir = '/workspace/Encs/src/CVCUNETR/pvt_v2_b2.pth'):
+    def __init__(self, in_channels=3, total_channels = 100, i_channels=6, t_channels=15, v_channels=10, num_heads=10, dims=[64, 128, 320, 512], out_dim=32, kernel_size=3, mlp_ratio=4, model_dir = '/workspace/Encs/src/CVCUNETR/pvt_v2_b2.pth', amp_dtype=torch.bfloat16, compile_blocks=False, use_side_streams=True, conv_norm=False, fused_norm=True):
         super(EndoForm, self).__init__()
-        self.backbone = pvt_v2_b2(in_chans=in_channels,embed_dims=dims)
+        # autocast dtype of the backbone and decoder, None runs everything in fp32
+        self.amp_dtype = amp_dtype
+        # compile_blocks compiles every backbone Block in place, do not also torch.compile the whole model then
+        # fused_norm=False keeps nn.LayerNorm for a model that is torch.compile'd as a whole
+        self.compile_blocks = compile_blocks
+        # conv_norm swaps the patch-embed LayerNorm for a foldable BatchNorm2d, the pvt_v2_b2 checkpoint only has the
+        # LayerNorm weights, so it changes the pretrained backbone and is meant for training from scratch
+        self.backbone = pvt_v2_b2(in_chans=in_channels,embed_dims=dims, compile_blocks=compile_blocks, conv_norm=conv_norm, fused_norm=fused_norm)
         if os.path.isfile(model_dir):
             model_dir = '/root/.cache/huggingface/forget/pvt_v2_b3.pth'
             save_model = torch.load(model_dir)
-            model_dict = self.backbone.state_dict()
-            state_dict = {k: v for k, v in save_model.items() if k in model_dict.keys()}
-            model_dict.update(state_dict)
-            self.backbone.load_state_dict(model_dict)
+            # non-strict so Attention can remap the checkpoint's q/kv weights before unknown keys are dropped
+            self.backbone.load_state_dict(save_model, strict=False)
         
         c1_in_channels, c2_in_channels, c3_in_channels, c4_in_channels = dims[0], dims[1], dims[2], dims[3]
         
@@ -742,33 +795,115 @@ class EndoForm(nn.Module):
         # self.SBA = SBA(input_dim = out_dim,out_channels=out_channels)
         # self.g = GlobalSparseTransformer(out_dim*2, r=4, heads=2)
         # self.l = LocalReverseDiffusion(in_channels=out_dim*2, out_channels=out_channels, r=4)
-        
-    def Upsample(self, x, size, align_corners = False):
+
+        # integer resize ratios from the backbone strides (c1..c4 at 1/4, 1/8, 1/16, 1/32), inputs are multiples of 32 (256 x 448)
+        self.r_c4_c2 = 4
+        self.r_c3_c2 = 2
+        self.r_h_l = 2
+        # side streams of the independent block4 / L_feature branches, created on the first CUDA forward
+        self.use_side_streams = use_side_streams
+        self._side_streams = None
+
+        # NHWC conv weights for cuDNN / tensor cores
+        self.to(memory_format=torch.channels_last)
+
+    def reparameterize(self):
+        """
+        Fold every BN / branch into its conv for inference, call after model.eval()
+        """
+        for m in list(self.modules()):
+            if isinstance(m, (OverlapPatchEmbed, Attention, BasicConv2d, GobleAttention)):
+                m.fuse()
+        return self
+
+    @torch.no_grad()
+    def capture_cudagraph(self, example_input, warmup=3):
+        """
+        Capture the eval forward of one fixed input shape as a single CUDA graph, returns a function that replays it
+        batch size and H, W of every later input must match example_input, true for the fixed 256 x 448 frames
+        training steps get their CUDA graphs from torch.compile(mode="reduce-overhead") in Endomain instead
+        """
+        assert not self.compile_blocks, "reduce-overhead Blocks capture their own CUDA graphs, build EndoForm with compile_blocks=False"
+        static_input = example_input.detach().clone().contiguous(memory_format=torch.channels_last)
+
+        # warm up on a side stream so cuDNN autotune and the allocator settle before capture
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(warmup):
+                self(static_input)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_output = self(static_input)
+
+        def replay(x):
+            static_input.copy_(x)
+            graph.replay()
+            return tuple(out.clone() for out in static_output)
+
+        return replay
+
+    def side_streams(self, x):
+        """
+        two CUDA side streams for eager CUDA runs, None on CPU, under torch.compile / jit.trace or with use_side_streams off
+        """
+        if not self.use_side_streams or not x.is_cuda or torch.compiler.is_compiling() or torch.jit.is_tracing():
+            return None
+        if self._side_streams is None:
+            self._side_streams = (torch.cuda.Stream(x.device), torch.cuda.Stream(x.device))
+        return self._side_streams
+
+    def Upsample(self, x, scale_factor, align_corners = False):
         """
-        Wrapper Around the Upsample Call
+        Wrapper Around the Upsample Call, a fixed integer scale_factor instead of a per-call target size
         """
-        return nn.functional.interpolate(x, size=size, mode='bilinear', align_corners=align_corners)
+        return F.interpolate(x, scale_factor=scale_factor, mode='bilinear', align_corners=align_corners, recompute_scale_factor=False)
         
     def forward(self, x):
-        pvt = self.backbone(x)
-        c1, c2, c3, c4 = pvt
-        
-        _c4 = self.block4(c4) # [1, 64, 11, 11]
-        _c4 = self.Upsample(_c4, c3.size()[2:])
-        # _c4 = F.interpolate(_c4, size=c3.size()[2:], mode='trilinear', align_corners=False)
-        _c3 = self.block3(c3) # [1, 64, 22, 22]
-        _c2 = self.block2(c2) # [1, 64, 44, 44]
-        # verb
-        output = self.fuse2(torch.cat([self.Upsample(_c4, c2.size()[2:]), self.Upsample(_c3, c2.size()[2:])], dim=1))
-        
-        verb_output = self.verb_classifier(output)
-        
-        L_feature = self.L_feature(c1)  # [1, 64, 88, 88]
-        H_feature = self.fuse(_c2)
-        H_feature = self.Upsample(H_feature,L_feature.size()[2:])
+        # channels_last keeps the token <-> conv reshapes of the backbone as free views
+        x = x.contiguous(memory_format=torch.channels_last)
+        # backbone + decoder under autocast, nn.LayerNorm / softmax are run in fp32 by autocast itself,
+        # apex FusedLayerNorm (eager Blocks) is not on autocast's fp32 list: it casts input and affine to amp_dtype
+        # and only accumulates the mean / variance in fp32, its output stays in amp_dtype
+        with torch.autocast(device_type=x.device.type, dtype=self.amp_dtype or torch.float32, enabled=self.amp_dtype is not None):
+            pvt = self.backbone(x)
+            c1, c2, c3, c4 = pvt
+
+            # block4 and L_feature do not depend on the block3 / block2 chain, overlap them on side streams
+            side = self.side_streams(x)
+            if side is None:
+                _c4 = self.block4(c4) # [1, 64, 11, 11]
+                L_feature = self.L_feature(c1)  # [1, 64, 88, 88]
+            else:
+                main = torch.cuda.current_stream(x.device)
+                for stream in side:
+                    stream.wait_stream(main)
+                with torch.cuda.stream(side[0]):
+                    _c4 = self.block4(c4)
+                with torch.cuda.stream(side[1]):
+                    L_feature = self.L_feature(c1)
+            _c3 = self.block3(c3) # [1, 64, 22, 22]
+            _c2 = self.block2(c2) # [1, 64, 44, 44]
+            if side is not None:
+                for stream in side:
+                    main.wait_stream(stream)
+                # allocated on the side streams, used on the main one from here on
+                _c4.record_stream(main)
+                L_feature.record_stream(main)
+            # verb, _c4 goes to c2 size in one resize instead of through c3 size
+            output = self.fuse2(torch.cat([self.Upsample(_c4, self.r_c4_c2), self.Upsample(_c3, self.r_c3_c2)], dim=1))
+
+            H_feature = self.fuse(_c2)
+            H_feature = self.Upsample(H_feature, self.r_h_l)
+
+            instrument_output, target_output = self.two_classifier(L_feature, H_feature)
+
+        # the small classification heads stay in fp32
+        instrument_output, target_output = instrument_output.float(), target_output.float()
+        verb_output = self.verb_classifier(output.float())
 
-        instrument_output, target_output = self.two_classifier(L_feature, H_feature)
-        
         triplet_output = self.classifier((instrument_output, target_output, verb_output))
         
         return instrument_output, verb_output, target_output, triplet_output
@@ -781,7 +916,8 @@ if __name__ == '__main__':
     x = torch.randn(size=(1, 3, 256, 448)).to(device)
     # test_x = torch.randn(size=(2, 64, 88, 88)).to(device)
     
-    model = EndoForm(in_channels=3).to(device)
+    model = EndoForm(in_channels=3, fused_norm=False).to(device)
+    model = torch.compile(model, mode="reduce-overhead", dynamic=False)
     # module = AttentionBlock(in_dim=64, out_dim=32, kernel_size=3, mlp_ratio=4, shallow=True).to(device)
     tool, verb, target, triplet = model(x)
     print(tool.size())
@@ -789,5 +925,11 @@ if __name__ == '__main__':
     print(target.size())
     print(triplet.size())
 
+    # the same fixed-shape forward, heads included, as a single CUDA graph replay
+    graph_model = EndoForm(in_channels=3, compile_blocks=False).to(device).eval()
+    replay = graph_model.capture_cudagraph(x)
+    tool, verb, target, triplet = replay(torch.randn_like(x))
+    print(triplet.size())
+
     
     
\ No newline at end of file
@@ -66,6 +66,7 @@ class CholecT50():
         self.augmentation_list = []
         for aug in augmentation_list:
             self.augmentation_list.append(self.augmentations[aug])
+        self.build_text_cache()
         trainform, testform = self.transform()
         self.build_train_dataset(trainform)
         self.build_val_dataset(trainform)
@@ -166,58 +167,50 @@ class CholecT50():
     def build(self):
         return (self.train_dataset, self.val_dataset, self.test_dataset)
 
+    # 预先读取并编码所有句子, 训练时只做拼接
+    def build_text_cache(self):
+        """
+        Read the first 20 sentences of every text file once, mask the class words and convert them to token ids.
+        text_cache[category][label] is a list of 20 id lists.
+        """
+        mask_lists = {'instrument': self.instrument_list, 'target': self.target_list, 'verb': self.verb_list}
+        self.text_cache = {}
+        for category, mask_list in mask_lists.items():
+            text_folder = os.path.join(self.text_path, category)
+            self.text_cache[category] = {}
+            for text_name in os.listdir(text_folder):
+                label, ext = os.path.splitext(text_name)
+                if ext != '.txt':
+                    continue
+                text_file = os.path.join(text_folder, text_name)
+                with open(text_file, 'r', encoding='utf-8') as f:
+                    lines = f.readlines()
+                if len(lines) < 20:
+                    raise ValueError(f"{text_file} does not have 20 sentences.")
+                sentences = []
+                for line in lines[:20]:
+                    words = ['[MASK]' if word in mask_list else word for word in line.strip().split()]
+                    sentences.append(self.tokenizer.convert_tokens_to_ids(words))
+                self.text_cache[category][label] = sentences
+
     #随机获取句子
     def get_random_sentence(self, category, label):
         """
         - category (str): 类别，'instrument', 'target', 或 'verb'。
         - label (str): 标签， 'grasper', 'hook', 'action' 等。
+        return: token ids of the masked sentence
         """
-        text_folder = os.path.join(self.text_path, category)
-        text_file = os.path.join(text_folder, f"{label}.txt")
-
-        if not os.path.exists(text_file):
+        sentences = self.text_cache[category].get(str(label))
+        if sentences is None:
             raise FileNotFoundError(f"File for {label} under {category} not found.")
 
-        # 打开文本文件并读取前 20 句
-        with open(text_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-
-            # TODO: 换成 20
-            if len(lines) < 20:
-                raise ValueError(f"{text_file} does not have 20 sentences.")
-
-            # 从前 20 句中随机选择一句
-            random_sentence = random.choice(lines[:20])
-
-        return random_sentence.strip()
+        # 从前 20 句中随机选择一句
+        return random.choice(sentences)
 
     # Mask操作
-    def apply_mask(self, instrument, target, verb, all_list, max_len=100):
-        input_text = '[CLS] ' + instrument + ' [SEP] ' + '[CLS] ' + target + ' [SEP] ' + '[CLS] ' + verb + ' [SEP]'
-        input_text = input_text.split()
-        masked_index = []
-        cls_num = 0
-        instrument_list, target_list, verb_list = all_list
-        
-        # 遍历单词并进行mask
-        for word_num in range(len(input_text)):
-            if cls_num == 1 and input_text[word_num] in instrument_list:
-                input_text[word_num] = '[MASK]'
-                masked_index.append(word_num)
-
-            if cls_num == 2 and input_text[word_num] in target_list:
-                input_text[word_num] = '[MASK]'
-                masked_index.append(word_num)
-
-            if cls_num == 3 and input_text[word_num] in verb_list:
-                input_text[word_num] = '[MASK]'
-                masked_index.append(word_num)
-
-            if input_text[word_num] == '[CLS]':
-                cls_num += 1
-
-        # 将句子转为id   
-        indexed_tokens = self.tokenizer.convert_tokens_to_ids(input_text)
+    def apply_mask(self, instrument, target, verb, max_len=100):
+        cls_id, sep_id = self.tokenizer.convert_tokens_to_ids(['[CLS]', '[SEP]'])
+        indexed_tokens = [cls_id] + instrument + [sep_id] + [cls_id] + target + [sep_id] + [cls_id] + verb + [sep_id]
 
         # 使用 max_len 参数进行填充和截断
         if len(indexed_tokens) < max_len:
@@ -227,21 +220,18 @@ class CholecT50():
             # 如果长度超出，进行截断
             indexed_tokens = indexed_tokens[:max_len]
 
-        # 将句子转为tensor
-        input_tensor = torch.tensor([indexed_tokens])
-
-        # 将句子转为tensor
-       # indexed_tokens = tokenizer.convert_tokens_to_ids(input_text)
-        #input_tensor = torch.tensor([indexed_tokens])
+        # 将句子转为tensor, [max_len]
+        input_tensor = torch.tensor(indexed_tokens)
 
         return input_tensor
 
 class T50(Dataset):
     def __init__(self, img_dir, triplet_file, tool_file, verb_file, target_file, transform=None, target_transform=None, apply_mask_func=None, get_sentence_func=None):
+        # labels are kept in float32 so the training loop does not upcast them every batch
         self.triplet_labels = np.loadtxt(triplet_file, dtype=int, delimiter=',')
-        self.tool_labels = np.loadtxt(tool_file, dtype=int, delimiter=',')
-        self.verb_labels = np.loadtxt(verb_file, dtype=int, delimiter=',')
-        self.target_labels = np.loadtxt(target_file, dtype=int, delimiter=',')
+        self.tool_labels = np.loadtxt(tool_file, dtype=np.float32, delimiter=',')
+        self.verb_labels = np.loadtxt(verb_file, dtype=np.float32, delimiter=',')
+        self.target_labels = np.loadtxt(target_file, dtype=np.float32, delimiter=',')
         
         self.img_dir = img_dir
         self.transform = transform
@@ -258,7 +248,7 @@ class T50(Dataset):
         return len(self.triplet_labels)
 
     def __getitem__(self, index):
-        triplet_label = self.triplet_labels[index, 1:]
+        triplet_label = self.triplet_labels[index, 1:].astype(np.float32)
         tool_label = self.tool_labels[index, 1:]
         verb_label = self.verb_labels[index, 1:]
         target_label = self.target_labels[index, 1:]
@@ -284,10 +274,8 @@ class T50(Dataset):
         target_sentence = self.get_sentence_func('target', np.argmax(target_label))
         verb_sentence = self.get_sentence_func('verb', np.argmax(verb_label))
 
-        # 对文本进行mask并转换为tensor
-        all_list = [self.instrument_list, self.target_list, self.verb_list]      
-      
-        txt_tensor = self.apply_mask_func(instrument_sentence, target_sentence, verb_sentence, all_list)
+        # 拼接已mask的句子并转换为tensor
+        txt_tensor = self.apply_mask_func(instrument_sentence, target_sentence, verb_sentence)
 
         return image, txt_tensor, (tool_label, verb_label, target_label, triplet_label)
 
@@ -302,13 +290,13 @@ def give_dataset(config, tokenizer):
             tokenizer = tokenizer
             )
     train_dataset, val_dataset, test_dataset = dataset.build()
-    train_dataloader = DataLoader(train_dataset, batch_size=config.batch_size, shuffle=True, prefetch_factor=3*config.batch_size, num_workers=config.num_workers, pin_memory=config.pin_memory, persistent_workers=config.persistent_workers, drop_last=config.drop_last)
-    val_dataloader   = DataLoader(val_dataset, batch_size=config.batch_size, shuffle=False, prefetch_factor=3*config.batch_size, num_workers=config.num_workers, pin_memory=config.pin_memory, persistent_workers=config.persistent_workers, drop_last=config.drop_last)
+    train_dataloader = DataLoader(train_dataset, batch_size=config.batch_size, shuffle=True, prefetch_factor=2, num_workers=config.num_workers, pin_memory=config.pin_memory, persistent_workers=config.persistent_workers, drop_last=config.drop_last)
+    val_dataloader   = DataLoader(val_dataset, batch_size=config.batch_size, shuffle=False, prefetch_factor=2, num_workers=config.num_workers, pin_memory=config.pin_memory, persistent_workers=config.persistent_workers, drop_last=config.drop_last)
     
     # test data set is built per video, so load differently
     test_dataloaders = []
     for video_dataset in test_dataset:
-        test_dataloader = DataLoader(video_dataset, batch_size=config.batch_size, shuffle=False, prefetch_factor=3*config.batch_size, num_workers=config.num_workers, pin_memory=config.pin_memory, persistent_workers=config.persistent_workers, drop_last=config.drop_last)
+        test_dataloader = DataLoader(video_dataset, batch_size=config.batch_size, shuffle=False, prefetch_factor=2, num_workers=config.num_workers, pin_memory=config.pin_memory, persistent_workers=config.persistent_workers, drop_last=config.drop_last)
         test_dataloaders.append(test_dataloader)
     
     return train_dataloader, val_dataloader, test_dataloader
@@ -362,9 +350,9 @@ if __name__ == '__main__':
     # train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, prefetch_factor=3*batch_size, num_workers=3, pin_memory=True, persistent_workers=True, drop_last=False)
     
     for batch, (img, txt,(y1, y2, y3, y4)) in enumerate(train_loader):
-            img, txt,y1, y2, y3, y4 = img.cuda(), txt.cuda(),y1.cuda(), y2.cuda(), y3.cuda(), y4.cuda()
+            img, txt,y1, y2, y3, y4 = img.cuda(non_blocking=True), txt.cuda(non_blocking=True),y1.cuda(non_blocking=True), y2.cuda(non_blocking=True), y3.cuda(non_blocking=True), y4.cuda(non_blocking=True)
             print(img.shape)
-            print(txt.squeeze().shape)
+            print(txt.shape)
             print(y1.shape)
             print(y2.shape)
             print(y3.shape)
@@ -1,15 +1,25 @@
 import os
 import random
 import sys
-from collections import OrderedDict
+import inspect
+import atexit
+import queue
+import threading
+from functools import lru_cache
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
 
 import math
 import numpy as np
 import torch
 from accelerate import Accelerator
+from accelerate.utils import broadcast, broadcast_object_list
 from einops.layers.torch import Rearrange
 from timm.models.layers import trunc_normal_
 from torch import nn
+from torch.utils.data import ConcatDataset
+
+from src.utils_numba import class_balanced_weights
 
 
 class MetricSaver(nn.Module):
@@ -17,30 +27,111 @@ class MetricSaver(nn.Module):
         super().__init__()
         self.best_acc = nn.Parameter(torch.zeros(1), requires_grad=False)
 
+# torch >= 2.1 can memory-map the checkpoint instead of reading it into RAM
+_TORCH_LOAD_MMAP = 'mmap' in inspect.signature(torch.load).parameters
+
 def load_model_dict(download_path, save_path=None, check_hash=True) -> OrderedDict:
     if download_path.startswith('http'):
         state_dict = torch.hub.load_state_dict_from_url(download_path, model_dir=save_path, check_hash=check_hash, map_location=torch.device('cpu'))
+    elif _TORCH_LOAD_MMAP:
+        try:
+            state_dict = torch.load(download_path, map_location=torch.device('cpu'), mmap=True, weights_only=True)
+        except RuntimeError:
+            # legacy (non-zip) checkpoints can not be memory-mapped
+            state_dict = torch.load(download_path, map_location=torch.device('cpu'), weights_only=True)
     else:
         state_dict = torch.load(download_path, map_location=torch.device('cpu'))
     return state_dict
 
 
+class PrefixStrippedStateDict(Mapping):
+    """
+    Read-only view of an already loaded state dict with the `_orig_mod.` prefix of torch.compile'd checkpoints
+    stripped from its keys (and from the keys of `_metadata`, which a rebuilt OrderedDict used to drop)
+    the tensors are not loaded lazily, nn.Module.load_state_dict still copies the view into its own OrderedDict
+    """
+    def __init__(self, state_dict, prefix='_orig_mod.'):
+        self.state_dict = state_dict
+        self.names = OrderedDict((k.replace(prefix, ''), k) for k in state_dict.keys())
+        metadata = getattr(state_dict, '_metadata', None)
+        if metadata is not None:
+            self._metadata = OrderedDict((k.replace(prefix, ''), v) for k, v in metadata.items())
+
+    def __getitem__(self, key):
+        return self.state_dict[self.names[key]]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+
+_TensorMeta = namedtuple('_TensorMeta', ['index', 'shape', 'dtype'])
+
+def _map_leaves(obj, fn, leaf_type=torch.Tensor):
+    if isinstance(obj, leaf_type):
+        return fn(obj)
+    if isinstance(obj, dict):
+        new = type(obj)((k, _map_leaves(v, fn, leaf_type)) for k, v in obj.items())
+        # the per-module version info of state dicts
+        if hasattr(obj, '_metadata'):
+            new._metadata = obj._metadata
+        return new
+    if isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+        return type(obj)(_map_leaves(v, fn, leaf_type) for v in obj)
+    return obj
+
+def load_and_broadcast(path, accelerator: Accelerator, load_fn=load_model_dict):
+    """
+    load_fn(path) on the main process only, the other ranks get the same (nested) object with its tensors broadcast onto accelerator.device
+    """
+    if accelerator.num_processes == 1:
+        return load_fn(path)
+    # the structure, the non-tensor leaves (epoch, param_groups, ...) and the tensor shapes / dtypes are pickled
+    # with broadcast_object_list, `broadcast` only gets the flat list of tensors, it rejects any other leaf type
+    meta, tensors = [None], []
+    if accelerator.is_main_process:
+        def collect(t):
+            tensors.append(t.to(accelerator.device))
+            return _TensorMeta(len(tensors) - 1, tuple(t.shape), t.dtype)
+        try:
+            meta[0] = _map_leaves(load_fn(path), collect)
+        except Exception as e:
+            meta[0] = e
+    broadcast_object_list(meta, from_process=0)
+    if isinstance(meta[0], Exception):
+        raise meta[0]
+    if not accelerator.is_main_process:
+        # the same traversal order as collect, so m.index is the list position
+        tensors = [torch.empty(m.shape, dtype=m.dtype, device=accelerator.device) for m in _flat_meta(meta[0])]
+    if tensors:
+        tensors = broadcast(tensors, from_process=0)
+    return _map_leaves(meta[0], lambda m: tensors[m.index], leaf_type=_TensorMeta)
+
+def _flat_meta(skeleton):
+    metas = []
+    _map_leaves(skeleton, metas.append, leaf_type=_TensorMeta)
+    return metas
+
+
 def resume_train_state(model, checkpoint, optimizers, schedulers, accelerator):
     try:
         base_path = f"{os.getcwd()}/model_store/{checkpoint}/checkpoint"
-        epoch_checkpoint = torch.load(base_path + "/epoch.pth.tar", map_location=accelerator.device)
+        load_on_device = lambda path: torch.load(path, map_location=accelerator.device)
+        epoch_checkpoint = load_and_broadcast(base_path + "/epoch.pth.tar", accelerator, load_on_device)
         best_score = epoch_checkpoint['best_score']
         best_metrics = epoch_checkpoint['best_metrics']
         starting_epoch = epoch_checkpoint['epoch'] + 1
         train_step = epoch_checkpoint['train_step']
         val_step = epoch_checkpoint['val_step']
         model = load_pretrain_model(base_path + "/pytorch_model.bin", model, accelerator)
-        if isinstance(optimizers, list):
+        if isinstance(optimizers, dict):
             optimizers = load_param(base_path, optimizers, accelerator, 'optimizer')
             schedulers = load_param(base_path, schedulers, accelerator, 'scheduler')
-        else:
-            optimizers.load_state_dict(torch.load(base_path + "/optimizer.bin"))
-            schedulers.load_state_dict(torch.load(base_path + "/scheduler.bin"))
+        elif optimizers is not None:
+            optimizers.load_state_dict(load_and_broadcast(base_path + "/optimizer.bin", accelerator, load_on_device))
+            schedulers.load_state_dict(load_and_broadcast(base_path + "/scheduler.bin", accelerator, load_on_device))
         
         accelerator.print(f'Loading training state successfully! Start training from {starting_epoch}, Best score: {best_score}')
         
@@ -53,7 +144,8 @@ def resume_train_state(model, checkpoint, optimizers, schedulers, accelerator):
 
 def load_pretrain_model(pretrain_path: str, model: nn.Module, accelerator: Accelerator):
     try:
-        state_dict = load_model_dict(pretrain_path)
+        # checkpoints saved from a torch.compile'd model carry the `_orig_mod.` prefix
+        state_dict = PrefixStrippedStateDict(load_and_broadcast(pretrain_path, accelerator))
         model.load_state_dict(state_dict)
         accelerator.print(f'Successfully loaded the training model！')
         return model
@@ -63,14 +155,19 @@ def load_pretrain_model(pretrain_path: str, model: nn.Module, accelerator: Accel
         return model
 
 
+@lru_cache(maxsize=None)
+def _patchify_layer(path_size):
+    # one Rearrange per patch size, the einops recipe is parsed once
+    return Rearrange('b c (h p1) (w p2) (d p3)-> b (h w d) (p1 p2 p3 c)', p1=path_size, p2=path_size, p3=path_size)
 
+def patchify(imgs, path_size):
     """
     把输入图片变成patch, 图片形状为立方体
     imgs: (N, modality, H, W, D)
     x: (N, L, patch_size_hw**2 * patch_size_depth) [batch_size, num_patches, 每个patch大小]
     """
 
-    imgs = Rearrange('b c (h p1) (w p2) (d p3)-> b (h w d) (p1 p2 p3 c)', p1=path_size, p2=path_size, p3=path_size)(imgs)
+    imgs = _patchify_layer(path_size)(imgs)
     # x = imgs.reshape(shape=(imgs.shape[0], modality, h, path_size, w, path_size, d, path_size))  # [N, modality, patch_h, patch_size, patch_w, patch_size, patch_d, patch_size]
     # x = torch.einsum('nmhowpdq->nhwdopqm', x)  # [N, patch_h, patch_w, patch_d, patch_size, patch_size, patch_size, modality]
     # imgs = x.reshape(shape=(x.shape[0], num_patches, path_size ** 3 * modality))  # [N, num_patches, pixel_patches]
@@ -85,36 +182,99 @@ def same_seeds(seed):
         torch.cuda.manual_seed(seed)
         torch.cuda.manual_seed_all(seed)
     np.random.seed(seed)
+    # cudnn autotune and TF32 convs / matmuls, runs are not bit-deterministic, TF32=0 turns TF32 off
     torch.backends.cudnn.benchmark = True
-    # torch.backends.cudnn.deterministic = True
+    torch.backends.cudnn.deterministic = False
+    tf32 = os.environ.get('TF32', '1') == '1'
+    torch.backends.cuda.matmul.allow_tf32 = tf32
+    torch.backends.cudnn.allow_tf32 = tf32
+    torch.set_float32_matmul_precision('high' if tf32 else 'highest')
 
 
 
-def init_weights(m):
-    if isinstance(m, nn.Linear):
-        trunc_normal_(m.weight, std=0.02)
-        if isinstance(m, nn.Linear) and m.bias is not None:
-            nn.init.constant_(m.bias, 0)
-    elif isinstance(m, nn.LayerNorm):
+def _init_linear(m):
+    trunc_normal_(m.weight, std=0.02)
+    if m.bias is not None:
         nn.init.constant_(m.bias, 0)
-        nn.init.constant_(m.weight, 1.0)
+
+def _init_ln(m):
+    nn.init.constant_(m.bias, 0)
+    nn.init.constant_(m.weight, 1.0)
+
+# exact type -> init fn, subclasses are resolved by isinstance once and cached, None for modules without an init
+_INIT_TABLE = {nn.Linear: _init_linear, nn.LayerNorm: _init_ln}
+
+def init_weights(m):
+    cls = type(m)
+    if cls not in _INIT_TABLE:
+        _INIT_TABLE[cls] = next((fn for base, fn in list(_INIT_TABLE.items()) if fn is not None and isinstance(m, base)), None)
+    fn = _INIT_TABLE[cls]
+    if fn is not None:
+        fn(m)
 
 
 
 
 class Logger(object):
-    def __init__(self, logdir: str):
+    """
+    Tee stdout / stderr into logdir/log.txt. Console writes happen in the caller, file writes are queued and
+    drained in batches by a background thread. flush() only hands the queued lines on without waiting,
+    sync() waits until they are written and forces them to disk (e.g. at checkpoints) and re-raises a failed
+    write, close() runs at exit so the lines after the last sync() are kept.
+    """
+    # ends the current batch of the drain thread, so flushed lines do not wait for a full batch / the interval
+    FLUSH = object()
+
+    def __init__(self, logdir: str, batch_lines=64, interval=0.1):
         self.console = sys.stdout
+        self.queue = queue.Queue()
+        self.batch_lines = batch_lines
+        self.interval = interval
+        self.thread = None
+        # the exception that stopped the drain thread, re-raised by sync()
+        self.error = None
         if logdir is not None:
             os.makedirs(logdir)
             self.log_file = open(logdir + '/log.txt', 'w')
+            # daemon: non-daemon threads are joined before atexit runs, so close() could never stop it
+            self.thread = threading.Thread(target=self.drain, daemon=True)
+            self.thread.start()
         else:
             self.log_file = None
+        self.stderr = sys.stderr
         sys.stdout = self
         sys.stderr = self
-
-    def __del__(self):
-        self.close()
+        atexit.register(self.close)
+
+    def drain(self):
+        while True:
+            lines = [self.queue.get()]
+            try:
+                while len(lines) < self.batch_lines and lines[-1] is not None and lines[-1] is not self.FLUSH:
+                    lines.append(self.queue.get(timeout=self.interval))
+            except queue.Empty:
+                pass
+            try:
+                self.log_file.write(''.join(line for line in lines if isinstance(line, str)))
+                self.log_file.flush()
+            except Exception as e:
+                self.error = e
+                return
+            finally:
+                for _ in lines:
+                    self.queue.task_done()
+            if lines[-1] is None:
+                return
+
+    def wait(self):
+        """
+        block until the queued lines are written, returns early when the drain thread has stopped
+        """
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks and self.thread.is_alive():
+                self.queue.all_tasks_done.wait(self.interval)
+        if self.error is not None:
+            raise self.error
 
     def __enter__(self):
         pass
@@ -124,141 +284,221 @@ class Logger(object):
 
     def write(self, msg):
         self.console.write(msg)
-        if self.log_file is not None:
-            self.log_file.write(msg)
+        if self.thread is not None and self.error is None:
+            self.queue.put(msg)
 
     def flush(self):
         self.console.flush()
-        if self.log_file is not None:
-            self.log_file.flush()
+        if self.thread is not None and self.error is None:
+            self.queue.put(self.FLUSH)
+
+    def sync(self):
+        if self.thread is not None:
+            self.flush()
+            self.wait()
             os.fsync(self.log_file.fileno())
 
     def close(self):
-        self.console.close()
-        if self.log_file is not None:
+        if sys.stdout is self:
+            sys.stdout = self.console
+        if sys.stderr is self:
+            sys.stderr = self.stderr
+        self.console.flush()
+        if self.thread is not None:
+            thread, self.thread = self.thread, None
+            self.queue.put(None)
+            # returns at once when the drain thread already stopped on a write error
+            thread.join()
+            if self.error is not None:
+                self.console.write(f'Logger: writing log.txt failed: {self.error!r}\n')
             self.log_file.close()
+        atexit.unregister(self.close)
+
+
+class DataPrefetcher(object):
+    """
+    Copy the next batch to the device on a side CUDA stream while the current batch is computed,
+    following apex/examples/imagenet/main_amp.py. The wrapped loader must not do device placement itself.
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        # a side stream only for CUDA targets, prefetching to the cpu is a plain synchronous copy
+        self.stream = torch.cuda.Stream() if torch.device(device).type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.preload()
+        while self.batch is not None:
+            yield self.next()
+
+    def to_device(self, data):
+        if isinstance(data, torch.Tensor):
+            return data.to(self.device, non_blocking=True)
+        if isinstance(data, (list, tuple)):
+            return type(data)(self.to_device(d) for d in data)
+        return data
+
+    def record_stream(self, data):
+        # the batch was allocated on the side stream, keep it alive until the compute stream is done with it
+        if isinstance(data, torch.Tensor):
+            data.record_stream(torch.cuda.current_stream())
+        elif isinstance(data, (list, tuple)):
+            for d in data:
+                self.record_stream(d)
+
+    def preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.batch = None
+            return
+        if self.stream is None:
+            self.batch = self.to_device(batch)
+            return
+        with torch.cuda.stream(self.stream):
+            self.batch = self.to_device(batch)
+
+    def next(self):
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            self.record_stream(self.batch)
+        batch = self.batch
+        self.preload()
+        return batch
+
+
+class AsyncCheckpointer(object):
+    """
+    torch.save a state dict on a background thread. Tensors are first staged into persistent (pinned) CPU buffers
+    with non_blocking copies, so training only waits for the D2H copy to be queued, not for the disk write.
+    """
+    def __init__(self):
+        self.buffers = {}
+        self.thread = None
+
+    def stage(self, name, tensor):
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != tensor.shape or buf.dtype != tensor.dtype:
+            buf = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=torch.cuda.is_available())
+            self.buffers[name] = buf
+        buf.copy_(tensor.detach(), non_blocking=True)
+        return buf
+
+    def save(self, state_dict, path):
+        # the buffers are reused, the previous write must be done with them
+        self.wait()
+        snapshot = OrderedDict((k, self.stage(k, v) if isinstance(v, torch.Tensor) else v) for k, v in state_dict.items())
+        event = None
+        if torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()
+        self.thread = threading.Thread(target=self.write, args=(snapshot, path, event))
+        self.thread.start()
+
+    def write(self, snapshot, path, event):
+        if event is not None:
+            event.synchronize()
+        torch.save(snapshot, path)
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
 
 
 def get_params_groups(model):
-    regularized = []
-    not_regularized = []
-    for name, param in model.named_parameters():
-        if not param.requires_grad:
-            continue
-        # we do not regularize biases nor Norm parameters
-        if name.endswith(".bias") or len(param.shape) == 1:
-            not_regularized.append(param)
-        else:
-            regularized.append(param)
+    params = [(name, param) for name, param in model.named_parameters() if param.requires_grad]
+    # we do not regularize biases nor Norm parameters
+    not_regularized = [param for name, param in params if param.ndim <= 1 or name.endswith(".bias")]
+    regularized = [param for name, param in params if not (param.ndim <= 1 or name.endswith(".bias"))]
     return [{'params': regularized}, {'params': not_regularized, 'weight_decay': 0.}]
 
 
 def get_world_size(accelerator):
     return accelerator.num_processes
 
-def get_weight_balancing(config):
+def _as_pinned_tensor(weight):
+    weight = torch.as_tensor(np.asarray(weight, dtype=np.float32))
+    return weight.pin_memory() if torch.cuda.is_available() else weight
+
+
+# float32 class weights per dataset variant (and k-fold for the cross-val splits), arrays named {variant}[_{fold}]_{task}
+# and randa_{task}, built from the tables of src/build_balancing.py (`python -m src.build_balancing`)
+BALANCING_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'weights', 'balancing.npz')
+
+@lru_cache(maxsize=None)
+def load_balancing_arrays(path=BALANCING_FILE):
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+# converted to tensors once on first use
+_WEIGHT_TENSORS = {}
+
+
+def get_label_balancing(dataset, beta):
+    """
+    class-balanced (tool, verb, target) weights counted from the label files of a (Concat)Dataset of T45 videos
+    """
+    videos = dataset.datasets if isinstance(dataset, ConcatDataset) else [dataset]
+    weights = []
+    for name in ['tool_labels', 'verb_labels', 'target_labels']:
+        # column 0 is the frame id
+        labels = np.ascontiguousarray(np.concatenate([getattr(video, name)[:, 1:] for video in videos]), dtype=np.int8)
+        weights.append(class_balanced_weights(labels, labels.shape[1], beta))
+    return weights
+
+def get_weight_balancing(config, dataset=None):
+    """
+    returns (tool, verb, target) float32 tensors, pinned when CUDA is available so `.to(device, non_blocking=True)` overlaps
+    with weight_randa and class_balanced_beta set, the weights are counted from `dataset` (the train set) instead
+    """
     dataset_choose = config.trainer.dataset
     if dataset_choose == 'T45':
         config = config.dataset.T45
     elif dataset_choose == 'T50':
         config = config.dataset.T50
-    # 50:   cholecT50, data splits as used in rendezvous paper
-    # 50ch: cholecT50, data splits as used in CholecTriplet challenge
-    # 45cv: cholecT45, official data splits (cross-val)
-    # 50cv: cholecT50, official data splits (cross-val)
     case = config.dataset_variant
-    switcher = {
-        'cholect50': {
-            'tool'  :   [0.08084519, 0.81435289, 0.10459284, 2.55976864, 1.630372490, 1.29528455],
-            'verb'  :   [0.31956735, 0.07252306, 0.08111481, 0.81137309, 1.302895320, 2.12264151, 1.54109589, 8.86363636, 12.13692946, 0.40462028],
-            'target':   [0.06246232, 1.00000000, 0.34266478, 0.84750219, 14.80102041, 8.73795181, 1.52845100, 5.74455446, 0.285756500, 12.72368421, 0.6250808,  3.85771277, 6.95683453, 0.84923888, 0.40130032]
-        },
-        'cholect50-challenge': {
-            'tool':     [0.08495163, 0.88782288, 0.11259564, 2.61948830, 1.784866470, 1.144624170],
-            'verb':     [0.39862805, 0.06981640, 0.08332925, 0.81876204, 1.415868390, 2.269359150, 1.28428410, 7.35822511, 18.67857143, 0.45704490],
-            'target':   [0.07333818, 0.87139287, 0.42853950, 1.00000000, 17.67281106, 13.94545455, 1.44880997, 6.04889590, 0.326188650, 16.82017544, 0.63577586, 6.79964539, 6.19547658, 0.96284208, 0.51559559]
-        },
-        'cholect45-crossval': {
-            1: {
-                'tool':     [0.08165644, 0.91226868, 0.10674758, 2.85418156, 1.60554885, 1.10640067],
-                'verb':     [0.37870137, 0.06836869, 0.07931255, 0.84780024, 1.21880342, 2.52836879, 1.30765704, 6.88888889, 17.07784431, 0.45241117],
-                'target':   [0.07149629, 1.0, 0.41013597, 0.90458015, 13.06299213, 12.06545455, 1.5213205, 5.04255319, 0.35808332, 45.45205479, 0.67493897, 7.04458599, 9.14049587, 0.97330595, 0.52633249]
-                },
-            2: {
-                'tool':     [0.0854156, 0.89535362, 0.10995253, 2.74936869, 1.78264429, 1.13234529],
-                'verb':     [0.36346863, 0.06771776, 0.07893261, 0.82842725, 1.33892161, 2.13049748, 1.26120359, 5.72674419, 19.7, 0.43189126],
-                'target':   [0.07530655, 0.97961957, 0.4325135, 0.99393438, 15.5387931, 14.5951417, 1.53862569, 6.01836394, 0.35184462, 15.81140351, 0.709506, 5.79581994, 8.08295964, 1.0, 0.52689272]
-            },
-            3: {
-                "tool" :   [0.0915228, 0.89714969, 0.12057004, 2.72128174, 1.94092281, 1.12948557],
-                "verb" :   [0.43636862, 0.07558554, 0.0891017, 0.81820519, 1.53645582, 2.31924198, 1.28565657, 6.49387755, 18.28735632, 0.48676763],
-                "target" : [0.06841828, 0.90980736, 0.38826607, 1.0, 14.3640553, 12.9875, 1.25939394, 5.38341969, 0.29060227, 13.67105263, 0.59168565, 6.58985201, 5.72977941, 0.86824513, 0.47682423]
-
-            },
-            4: {
-                'tool':     [0.08222218, 0.85414117, 0.10948695, 2.50868784, 1.63235867, 1.20593318],
-                'verb':     [0.41154261, 0.0692142, 0.08427214, 0.79895288, 1.33625219, 2.2624166, 1.35343681, 7.63, 17.84795322, 0.43970609],
-                'target':   [0.07536126, 0.85398445, 0.4085784, 0.95464422, 15.90497738, 18.5978836, 1.55875831, 5.52672956, 0.33700863, 15.41666667, 0.74755423, 5.4921875, 6.11304348, 1.0, 0.50641118],
-            },
-            5: {
-                'tool':     [0.0804654, 0.92271157, 0.10489631, 2.52302243, 1.60074906, 1.09141982],
-                'verb':     [0.50710436, 0.06590258, 0.07981184, 0.81538866, 1.29267277, 2.20525568, 1.29699248, 7.32311321, 25.45081967, 0.46733895],
-                'target':   [0.07119395, 0.87450495, 0.43043372, 0.86465981, 14.01984127, 23.7114094, 1.47577277, 5.81085526, 0.32129865, 22.79354839, 0.63304067, 6.92745098, 5.88833333, 1.0, 0.53175798]
-            }
-        },
-        'cholect50-crossval': {
-            1:{
-                'tool':     [0.0828851, 0.8876, 0.10830995, 2.93907285, 1.63884786, 1.14499484],
-                'verb':     [0.29628942, 0.07366916, 0.08267971, 0.83155428, 1.25402434, 2.38358209, 1.34938741, 7.56872038, 12.98373984, 0.41502079],
-                'target':   [0.06551745, 1.0, 0.36345711, 0.82434783, 13.06299213, 8.61818182, 1.4017744, 4.62116992, 0.32822238, 45.45205479, 0.67343211, 4.13200498, 8.23325062, 0.88527215, 0.43113306],
-
-            },
-            2:{
-                'tool':     [0.08586283, 0.87716737, 0.11068887, 2.84210526, 1.81016949, 1.16283571],
-                'verb':     [0.30072757, 0.07275414, 0.08350168, 0.80694143, 1.39209979, 2.22754491, 1.31448763, 6.38931298, 13.89211618, 0.39397505],
-                'target':   [0.07056703, 1.0, 0.39451115, 0.91977006, 15.86206897, 9.68421053, 1.44483706, 5.44378698, 0.31858714, 16.14035088, 0.7238395, 4.20571429, 7.98264642, 0.91360477, 0.43304307],
-            },
-            3:{
-            'tool':      [0.09225068, 0.87856006, 0.12195811, 2.82669323, 1.97710987, 1.1603972],
-                'verb':     [0.34285159, 0.08049804, 0.0928239, 0.80685714, 1.56125608, 2.23984772, 1.31471136, 7.08835341, 12.17241379, 0.43180428],
-                'target':   [0.06919395, 1.0, 0.37532866, 0.9830703, 15.78801843, 8.99212598, 1.27597765, 5.36990596, 0.29177312, 15.02631579, 0.64935557, 5.08308605, 5.86643836, 0.86580743, 0.41908257], 
-            },
-            4:{
-                'tool':     [0.08247885, 0.83095539, 0.11050268, 2.58193042, 1.64497676, 1.25538881],
-                'verb':     [0.31890981, 0.07380354, 0.08804592, 0.79094077, 1.35928144, 2.17017208, 1.42947103, 8.34558824, 13.19767442, 0.40666428],
-                'target':   [0.07777646, 0.95894072, 0.41993829, 0.95592153, 17.85972851, 12.49050633, 1.65701092, 5.74526929, 0.33763901, 17.31140351, 0.83747083, 3.95490982, 6.57833333, 1.0, 0.47139615],
-            },
-            5:{
-                'tool':     [0.07891691, 0.89878025, 0.10267677, 2.53805556, 1.60636428, 1.12691169],
-                'verb':     [0.36420961, 0.06825313, 0.08060635, 0.80956984, 1.30757221, 2.09375, 1.33625848, 7.9009434, 14.1350211, 0.41429631],
-                'target':   [0.07300329, 0.97128713, 0.42084942, 0.8829883, 15.57142857, 19.42574257, 1.56521739, 5.86547085, 0.32732733, 25.31612903, 0.70171674, 4.55220418, 6.13125, 1.0, 0.48528321],
-            }
-        }
-    }
-    if 'crossval' in config.dataset_variant:
-        tool_weight   = switcher.get(case)[config.kfold]['tool']
-        verb_weight   = switcher.get(case)[config.kfold]['verb']
-        target_weight = switcher.get(case)[config.kfold]['target']
-    else:
-        tool_weight   = switcher.get(case)['tool']
-        verb_weight   = switcher.get(case)['verb']
-        target_weight = switcher.get(case)['target']
+    if config.weight_randa == True and config.get('class_balanced_beta') and dataset is not None:
+        return tuple(_as_pinned_tensor(w) for w in get_label_balancing(dataset, config.class_balanced_beta))
     if config.weight_randa == True:
-        tool_weight     = [0.93487068, 0.94234964, 0.93487068, 1.18448115, 1.02368339, 0.97974447]
-        verb_weight     = [0.60002400, 0.60002400, 0.60002400, 0.61682467, 0.67082683, 0.80163207, 0.70562823, 2.11208448, 2.69230769, 0.60062402]
-        target_weight   = [0.49752894, 0.52041527, 0.49752894, 0.51394739, 2.71899565, 1.75577963, 0.58509403, 1.25228034, 0.49752894, 2.42993134, 0.49802647, 0.87266576, 1.36074165, 0.50150917, 0.49802647]
-
-    return tool_weight, verb_weight, target_weight
+        key = 'randa'
+    elif 'crossval' in case:
+        key = f'{case}_{config.kfold}'
+    else:
+        key = case
+    if key not in _WEIGHT_TENSORS:
+        arrays = load_balancing_arrays()
+        if f'{key}_tool' not in arrays:
+            raise KeyError(f'{BALANCING_FILE} has no class weights for {key}')
+        _WEIGHT_TENSORS[key] = tuple(_as_pinned_tensor(arrays[f'{key}_{name}']) for name in ['tool', 'verb', 'target'])
+    return _WEIGHT_TENSORS[key]
+
+def save_train_state(output_dir, model, optimizers, schedulers, accelerator):
+    """
+    accelerator.save_state for dicts of optimizers / schedulers: pytorch_model.bin plus a single optimizers.bin and
+    schedulers.bin, each holding every state dict keyed by str(i) in dict order, read back by load_param
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    model_state = accelerator.get_state_dict(model)
+    accelerator.save(model_state, os.path.join(output_dir, 'pytorch_model.bin'))
+    for type, param_dict in [('optimizer', optimizers), ('scheduler', schedulers)]:
+        accelerator.save({str(i): param.state_dict() for i, param in enumerate(param_dict.values())},
+                         os.path.join(output_dir, f'{type}s.bin'))
 
 def load_param(base_path, param_dict, accelerator, type='optimizer'):
-    num = 0
-    for key in param_dict.keys():
-        if num == 0:
-            add = ''
-        else:
-            add = f'_{num}'
-        param_dict[key].load_state_dict(torch.load(base_path + f"/{type}{add}.bin", map_location=accelerator.device))  
-        num += 1
+    """
+    one torch.load of the `{type}s.bin` written by save_train_state, dispatched to the params in dict order
+    """
+    # optimizer.load_state_dict moves the state onto the param device itself, so the file is mapped on cpu
+    load_fn = (lambda path: torch.load(path, map_location=torch.device('cpu'), mmap=True)) if _TORCH_LOAD_MMAP else \
+              (lambda path: torch.load(path, map_location=torch.device('cpu')))
+    states = load_and_broadcast(base_path + f"/{type}s.bin", accelerator, load_fn)
+    for i, key in enumerate(param_dict.keys()):
+        param_dict[key].load_state_dict(states[str(i)])
     return param_dict
         
 
@@ -0,0 +1,29 @@
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    # numba is optional, the same code runs as plain python / numpy
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+    prange = range
+
+
+@njit(parallel=True, cache=True)
+def class_balanced_weights(labels: np.ndarray, num_classes: int, beta: float) -> np.ndarray:
+    """
+    Class-balanced weights (Cui et al., effective number of samples) from a multi-hot label matrix
+    labels: (N, num_classes) int8, weights are normalized to sum to num_classes
+    """
+    weights = np.zeros(num_classes, dtype=np.float32)
+    for c in prange(num_classes):
+        count = 0
+        for i in range(labels.shape[0]):
+            if labels[i, c] > 0:
+                count += 1
+        # classes without samples get the weight of a single sample
+        count = max(count, 1)
+        weights[c] = (1.0 - beta) / (1.0 - beta ** count)
+    return weights * (num_classes / weights.sum())
@@ -0,0 +1,86 @@
+import torch
+import torch.nn.functional as F
+
+from src.models.EndoForm import Attention, BasicConv2d, GobleAttention, Mlp
+
+
+def randomize_bn(bn):
+    with torch.no_grad():
+        bn.weight.uniform_(0.5, 1.5)
+        bn.bias.uniform_(-0.5, 0.5)
+        bn.running_mean.uniform_(-0.5, 0.5)
+        bn.running_var.uniform_(0.5, 1.5)
+
+
+def test_basic_conv_fuse_matches_eval_output():
+    module = BasicConv2d(4, 8, 3, padding=2, dilation=2)
+    # a non-default padding mode / dtype has to survive the rebuilt conv
+    module.conv.padding_mode = 'reflect'
+    module = module.to(torch.float64).eval()
+    randomize_bn(module.bn)
+    x = torch.randn(2, 4, 16, 16, dtype=torch.float64)
+    expected = module(x)
+
+    conv = module.fuse()
+    assert isinstance(module.bn, torch.nn.Identity)
+    assert conv.padding_mode == 'reflect' and conv.dilation == (2, 2)
+    assert conv.weight.dtype == torch.float64 and conv.bias.dtype == torch.float64
+    assert conv.weight.device == x.device
+    torch.testing.assert_close(module(x), expected)
+
+
+def test_attention_loads_pvt_q_kv_checkpoint():
+    dim, heads, B, N = 16, 2, 2, 12
+    fused = Attention(dim, num_heads=heads, qkv_bias=True, sr_ratio=1).eval()
+    # the pretrained PVT layout: separate q and kv linears
+    q_w, q_b = torch.randn(dim, dim), torch.randn(dim)
+    kv_w, kv_b = torch.randn(2 * dim, dim), torch.randn(2 * dim)
+    proj_w, proj_b = torch.randn(dim, dim), torch.randn(dim)
+    state_dict = {'q.weight': q_w, 'q.bias': q_b, 'kv.weight': kv_w, 'kv.bias': kv_b, 'proj.weight': proj_w, 'proj.bias': proj_b}
+    fused.load_state_dict(state_dict)
+
+    x = torch.randn(B, N, dim)
+    q = F.linear(x, q_w, q_b).reshape(B, N, heads, dim // heads).permute(0, 2, 1, 3)
+    kv = F.linear(x, kv_w, kv_b).reshape(B, N, 2, heads, dim // heads).permute(2, 0, 3, 1, 4)
+    attn = (q @ kv[0].transpose(-2, -1) * fused.scale).softmax(dim=-1)
+    expected = F.linear((attn @ kv[1]).transpose(1, 2).reshape(B, N, dim), proj_w, proj_b)
+    torch.testing.assert_close(fused(x, 3, 4), expected)
+
+
+def test_attention_fuse_folds_sr_norm_affine_into_kv():
+    dim, H, W = 16, 4, 4
+    module = Attention(dim, num_heads=2, qkv_bias=True, sr_ratio=2).eval()
+    with torch.no_grad():
+        module.norm.weight.uniform_(0.5, 1.5)
+        module.norm.bias.uniform_(-0.5, 0.5)
+    x = torch.randn(2, H * W, dim)
+    expected = module(x, H, W)
+
+    module.fuse()
+    assert not module.norm.elementwise_affine
+    torch.testing.assert_close(module(x, H, W), expected)
+
+
+def test_mlp_conv_path_matches_linear_path():
+    dim, hidden, B, H, W = 8, 32, 2, 4, 6
+    module = Mlp(dim, hidden_features=hidden).eval()
+    x = torch.randn(B, H * W, dim)
+
+    # the original token-major PVT Mlp: Linear, NCHW depthwise conv, Linear
+    h = module.fc1(x)
+    h = h.transpose(1, 2).reshape(B, hidden, H, W)
+    h = module.dwconv(h).flatten(2).transpose(1, 2)
+    expected = module.fc2(module.act(h))
+    torch.testing.assert_close(module(x, H, W), expected)
+
+
+def test_goble_attention_fuse_matches_eval_output():
+    module = GobleAttention(in_dim=4, out_dim=8).eval()
+    randomize_bn(module.base_norm)
+    randomize_bn(module.add_norm)
+    x = torch.randn(2, 4, 10, 12)
+    expected = module(x)
+
+    module.fuse()
+    assert hasattr(module, 'rep_conv') and not hasattr(module, 'base_conv')
+    torch.testing.assert_close(module(x), expected)
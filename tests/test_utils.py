@@ -0,0 +1,181 @@
+import time
+import pickle
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import torch
+
+from src import utils
+
+
+def fake_broadcasts(monkeypatch, sent):
+    """
+    broadcast / broadcast_object_list of rank 0 record what they send, the other ranks get it back
+    accelerate's broadcast rejects every non-tensor leaf, so the fake one does too
+    """
+    def broadcast_object_list(object_list, from_process=0):
+        if 'objects' in sent:
+            object_list[:] = pickle.loads(sent['objects'])
+        else:
+            sent['objects'] = pickle.dumps(object_list)
+        return object_list
+
+    def broadcast(tensors, from_process=0):
+        assert isinstance(tensors, list) and all(isinstance(t, torch.Tensor) for t in tensors)
+        if 'tensors' in sent:
+            assert [(t.shape, t.dtype) for t in tensors] == [(t.shape, t.dtype) for t in sent['tensors']]
+            return [t.clone() for t in sent['tensors']]
+        sent['tensors'] = [t.clone() for t in tensors]
+        return tensors
+
+    monkeypatch.setattr(utils, 'broadcast_object_list', broadcast_object_list)
+    monkeypatch.setattr(utils, 'broadcast', broadcast)
+
+
+def test_load_and_broadcast_mixed_leaves(monkeypatch):
+    state_dict = OrderedDict([('weight', torch.randn(3, 4)), ('steps', torch.tensor(7, dtype=torch.int64))])
+    state_dict._metadata = OrderedDict([('', {'version': 2})])
+    checkpoint = {'epoch': 4, 'best_score': 0.5, 'best_metrics': {'ivt': 0.25}, 'train_step': 120,
+                  'param_groups': [{'lr': 1e-3, 'params': [0, 1]}], 'state': state_dict}
+    sent = {}
+    fake_broadcasts(monkeypatch, sent)
+
+    main = SimpleNamespace(num_processes=2, is_main_process=True, device=torch.device('cpu'))
+    other = SimpleNamespace(num_processes=2, is_main_process=False, device=torch.device('cpu'))
+    on_main = utils.load_and_broadcast('epoch.pth.tar', main, lambda path: checkpoint)
+    on_other = utils.load_and_broadcast('epoch.pth.tar', other, lambda path: only_main_loads())
+
+    for loaded in [on_main, on_other]:
+        assert loaded['epoch'] == 4 and loaded['train_step'] == 120
+        assert loaded['best_score'] == 0.5 and loaded['best_metrics'] == {'ivt': 0.25}
+        assert loaded['param_groups'] == [{'lr': 1e-3, 'params': [0, 1]}]
+        assert torch.equal(loaded['state']['weight'], state_dict['weight'])
+        assert torch.equal(loaded['state']['steps'], state_dict['steps'])
+        assert loaded['state']._metadata == state_dict._metadata
+
+
+def only_main_loads():
+    raise AssertionError('only the main process loads the file')
+
+
+def test_logger_sync_writes_queued_lines(tmp_path):
+    stdout = utils.sys.stdout
+    logger = utils.Logger(str(tmp_path / 'log'))
+    print('dice ivt score')
+    logger.sync()
+    assert (tmp_path / 'log' / 'log.txt').read_text() == 'dice ivt score\n'
+    print('other metrics')
+    logger.close()
+    assert utils.sys.stdout is stdout
+    assert (tmp_path / 'log' / 'log.txt').read_text() == 'dice ivt score\nother metrics\n'
+
+
+def test_logger_sync_returns_when_drain_thread_died(tmp_path):
+    stdout = utils.sys.stdout
+    logger = utils.Logger(str(tmp_path / 'log'))
+    logger.log_file.close()
+    print('lost line', flush=True)
+    try:
+        logger.sync()
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('sync() should re-raise the failed write')
+    finally:
+        logger.log_file = open(tmp_path / 'log' / 'log.txt', 'a')
+        logger.close()
+    assert utils.sys.stdout is stdout
+
+
+def test_train_state_round_trip_one_file_per_type(tmp_path):
+    accelerator = SimpleNamespace(num_processes=1, get_state_dict=lambda model: model.state_dict(), save=torch.save)
+    model = torch.nn.Linear(4, 2)
+    optimizers = {'optimizer_i': torch.optim.AdamW(model.parameters(), lr=1e-3),
+                  'optimizer_vt': torch.optim.SGD(model.parameters(), lr=1e-2, momentum=0.9)}
+    schedulers = {key: torch.optim.lr_scheduler.StepLR(opt, step_size=1) for key, opt in optimizers.items()}
+    model(torch.randn(3, 4)).sum().backward()
+    for opt in optimizers.values():
+        opt.step()
+    for sched in schedulers.values():
+        sched.step()
+
+    utils.save_train_state(str(tmp_path), model, optimizers, schedulers, accelerator)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['optimizers.bin', 'pytorch_model.bin', 'schedulers.bin']
+
+    restored = {'optimizer_i': torch.optim.AdamW(model.parameters(), lr=1.0),
+                'optimizer_vt': torch.optim.SGD(model.parameters(), lr=1.0, momentum=0.9)}
+    restored_schedulers = {key: torch.optim.lr_scheduler.StepLR(opt, step_size=1) for key, opt in restored.items()}
+    utils.load_param(str(tmp_path), restored, accelerator, 'optimizer')
+    utils.load_param(str(tmp_path), restored_schedulers, accelerator, 'scheduler')
+    for key in optimizers:
+        assert restored[key].param_groups[0]['lr'] == optimizers[key].param_groups[0]['lr']
+        assert restored_schedulers[key].last_epoch == schedulers[key].last_epoch
+    exp_avg = optimizers['optimizer_i'].state[model.weight]['exp_avg']
+    torch.testing.assert_close(restored['optimizer_i'].state[model.weight]['exp_avg'], exp_avg)
+
+
+def test_balancing_file_matches_the_build_tables():
+    import numpy as np
+    from src.build_balancing import balancing_arrays
+
+    built, stored = balancing_arrays(), utils.load_balancing_arrays()
+    assert sorted(built) == sorted(stored)
+    for name, weights in built.items():
+        assert stored[name].dtype == np.float32
+        np.testing.assert_array_equal(stored[name], weights)
+
+
+def test_data_prefetcher_yields_the_loader_batches():
+    from torch.utils.data import DataLoader, TensorDataset
+
+    images, labels = torch.randn(10, 3, 4, 4), torch.arange(10)
+    loader = DataLoader(TensorDataset(images, labels), batch_size=4)
+    prefetcher = utils.DataPrefetcher(loader, torch.device('cpu'))
+    assert len(prefetcher) == len(loader) == 3
+    # iterating again starts a fresh pass over the loader
+    for _ in range(2):
+        batches = list(prefetcher)
+        assert len(batches) == 3
+        for (img, label), (ref_img, ref_label) in zip(batches, loader):
+            assert torch.equal(img, ref_img) and torch.equal(label, ref_label)
+    iterator = iter(prefetcher)
+    for _ in range(3):
+        next(iterator)
+    try:
+        next(iterator)
+    except StopIteration:
+        pass
+    else:
+        raise AssertionError('the prefetcher should stop after the last batch')
+
+
+class RecordingCheckpointer(utils.AsyncCheckpointer):
+    def __init__(self):
+        super().__init__()
+        self.log = []
+
+    def write(self, snapshot, path, event):
+        self.log.append(('start', path))
+        # a slow disk, the next save has to wait for this write before reusing the staged buffers
+        time.sleep(0.2)
+        super().write(snapshot, path, event)
+        self.log.append(('end', path))
+
+
+def test_async_checkpointer_saves_and_serializes_writes(tmp_path):
+    first = OrderedDict([('weight', torch.randn(4, 3)), ('step', 1)])
+    second = OrderedDict([('weight', torch.randn(4, 3)), ('step', 2)])
+    expected = first['weight'].clone()
+    checkpointer = RecordingCheckpointer()
+    checkpointer.save(first, str(tmp_path / 'first.pth'))
+    # the snapshot is staged, later in-place updates of the live tensor do not reach the file
+    first['weight'].add_(1.0)
+    checkpointer.save(second, str(tmp_path / 'second.pth'))
+    checkpointer.wait()
+
+    assert checkpointer.log == [('start', str(tmp_path / 'first.pth')), ('end', str(tmp_path / 'first.pth')),
+                                ('start', str(tmp_path / 'second.pth')), ('end', str(tmp_path / 'second.pth'))]
+    loaded_first = torch.load(tmp_path / 'first.pth')
+    loaded_second = torch.load(tmp_path / 'second.pth')
+    assert torch.equal(loaded_first['weight'], expected) and loaded_first['step'] == 1
+    assert torch.equal(loaded_second['weight'], second['weight']) and loaded_second['step'] == 2
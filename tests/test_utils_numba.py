@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('numba')
+
+from src.utils_numba import class_balanced_weights
+
+
+def reference_weights(labels, num_classes, beta):
+    counts = np.maximum((labels > 0).sum(axis=0), 1)
+    weights = (1.0 - beta) / (1.0 - beta ** counts)
+    return weights * (num_classes / weights.sum())
+
+
+@pytest.mark.parametrize('beta', [0.9, 0.99, 0.9999])
+def test_class_balanced_weights_matches_numpy(beta):
+    rng = np.random.default_rng(0)
+    labels = (rng.random((500, 15)) < rng.random(15)).astype(np.int8)
+    # a class without samples falls back to the weight of one sample
+    labels[:, 3] = 0
+    weights = class_balanced_weights(labels, labels.shape[1], beta)
+    assert weights.dtype == np.float32
+    np.testing.assert_allclose(weights, reference_weights(labels, labels.shape[1], beta), rtol=1e-5)
+    assert weights.sum() == pytest.approx(labels.shape[1], rel=1e-5)